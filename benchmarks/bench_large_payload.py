@@ -0,0 +1,62 @@
+"""Measure transfer time of large messages from a worker to the manager,
+sent through the connection or handed over through a memory mapped file.
+
+Usage: python benchmarks/bench_large_payload.py [payload megabytes]
+"""
+import os
+import sys
+import time
+from multiprocessing import Process, Pipe
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..',
+                                'pytest_idapro'))
+from idapro_internal import transport  # noqa: E402
+
+
+def make_report(size):
+    # resembles a serialized TestReport with a large captured output
+    return {'nodeid': 'tests/test_module.py::test_output',
+            'sections': [('Captured stdout call', 'x' * size)]}
+
+
+def worker(conn, size, count, threshold):
+    report = make_report(size)
+    for _ in range(count):
+        message = ('runtest', 'logreport', report)
+        if threshold is None:
+            conn.send(message)
+        else:
+            transport.send_message(conn, message, threshold)
+    conn.close()
+
+
+def manager(conn, count):
+    for _ in range(count):
+        r = conn.recv()
+        if r[0] == 'payload':
+            r = transport.read_payload(r[1])
+
+
+def run(size, count, threshold):
+    manager_conn, worker_conn = Pipe()
+    proc = Process(target=worker, args=(worker_conn, size, count, threshold))
+    proc.start()
+    start = time.time()
+    manager(manager_conn, count)
+    elapsed = time.time() - start
+    proc.join()
+    return elapsed / count
+
+
+def main():
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    size = megabytes << 20
+    count = 10
+    for name, threshold in (("connection", None),
+                            ("mmap file", transport.PAYLOAD_THRESHOLD)):
+        print("{:>10}: {:8.2f} ms per {} MB message".format(
+            name, run(size, count, threshold) * 1000, megabytes))
+
+
+if __name__ == '__main__':
+    main()
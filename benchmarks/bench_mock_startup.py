@@ -0,0 +1,48 @@
+"""Measure mock plugin startup time: loading the plugin and importing only
+idc, compared to importing every mocked IDA module.
+
+Every measurement runs in a fresh interpreter.
+
+Usage: python benchmarks/bench_mock_startup.py [repeat]
+"""
+import os
+import sys
+import subprocess
+import timeit
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+SETUP = """
+from pytest_idapro.plugin_mock import MockDeferredPlugin, modules_list
+import sys
+plugin = MockDeferredPlugin()
+sys.meta_path.insert(0, plugin.finder)
+"""
+
+SCENARIOS = [
+    ("import idc", SETUP + "import idc\n"),
+    ("import all modules", SETUP + "for name in modules_list:\n"
+                                   "    __import__(name)\n"),
+]
+
+
+def run(code):
+    subprocess.check_call([sys.executable, '-c', code], cwd=ROOT)
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    baseline = min(timeit.repeat(lambda: run("pass"), number=1,
+                                 repeat=repeat))
+    for name, code in SCENARIOS:
+        try:
+            elapsed = min(timeit.repeat(lambda: run(code), number=1,
+                                        repeat=repeat))
+        except subprocess.CalledProcessError:
+            print("{:>20}: failed".format(name))
+            continue
+        print("{:>20}: {:8.1f} ms".format(name, (elapsed - baseline) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""Measure the overhead of reading attributes of a recorded IDA object, such
+as the fields of a func_t in a loop, compared to the unrecorded object.
+
+Usage: python benchmarks/bench_record_attributes.py [reads]
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..',
+                                'pytest_idapro'))
+from idapro_internal import record_module  # noqa: E402
+
+
+class func_t(object):
+    # pretend to be a class of an IDA module, so it is recorded
+    __module__ = 'ida_funcs'
+
+    def __init__(self, start_ea, end_ea):
+        self.start_ea = start_ea
+        self.end_ea = end_ea
+        self.flags = 0
+
+    def size(self):
+        return self.end_ea - self.start_ea
+
+
+def read_fields(func, reads):
+    for _ in range(reads):
+        func.start_ea
+        func.end_ea
+        func.flags
+
+
+def call_method(func, reads):
+    for _ in range(reads):
+        func.size()
+
+
+def main():
+    reads = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    records = record_module.RecordDict()
+    record_class = record_module.record_factory('func_t', func_t, records)
+    recorded = record_class(0x401000, 0x401100)
+    plain = func_t(0x401000, 0x401100)
+
+    for name, scenario in (("read fields", read_fields),
+                           ("call method", call_method)):
+        for kind, func in (("plain", plain), ("recorded", recorded)):
+            elapsed = min(timeit.repeat(lambda: scenario(func, reads),
+                                        number=1, repeat=3))
+            print("{:>12} {:>9}: {:8.1f} ns per iteration".format(
+                name, kind, elapsed / reads * 1e9))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""Measure runtest report streaming throughput from a worker to the manager,
+with and without message batching.
+
+Usage: python benchmarks/bench_report_stream.py [test count]
+"""
+import os
+import sys
+import time
+import collections
+from multiprocessing import Process, Pipe
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..',
+                                'pytest_idapro'))
+from idapro_internal.transport import BatchSender  # noqa: E402
+
+
+def make_report(i):
+    # resembles a serialized passing TestReport
+    nodeid = "tests/test_module.py::test_param[{}]".format(i)
+    return {'nodeid': nodeid, 'location': ('tests/test_module.py', 10, nodeid),
+            'keywords': {'test_param': 1, 'tests': 1}, 'outcome': 'passed',
+            'longrepr': None, 'when': 'call', 'user_properties': [],
+            'sections': [], 'duration': 0.0001}
+
+
+class Sender(object):
+    def __init__(self, conn):
+        self.conn = conn
+
+    def send(self, message):
+        self.conn.send(message)
+
+    send_batched = send
+
+    def boundary(self):
+        pass
+
+
+def worker(conn, count, batched):
+    sender = BatchSender(conn) if batched else Sender(conn)
+    sender.send(('runtest', 'start'))
+    for i in range(count):
+        report = make_report(i)
+        location = report['location']
+        sender.boundary()
+        sender.send_batched(('runtest', 'logstart', report['nodeid'],
+                             location))
+        for when in ('setup', 'call', 'teardown'):
+            report['when'] = when
+            sender.send_batched(('runtest', 'logreport', dict(report)))
+        sender.send_batched(('runtest', 'logfinish', report['nodeid'],
+                             location))
+    sender.send(('runtest', 'finish'))
+    conn.close()
+
+
+def manager(conn):
+    pending = collections.deque()
+    tests = 0
+    while True:
+        while not pending:
+            r = conn.recv()
+            if r[0] == 'batch':
+                pending.extend(r[1])
+            else:
+                pending.append(r)
+
+        r = pending.popleft()
+        if r == ('runtest', 'finish'):
+            return tests
+        elif r[1] == 'logfinish':
+            tests += 1
+
+
+def run(count, batched):
+    manager_conn, worker_conn = Pipe()
+    proc = Process(target=worker, args=(worker_conn, count, batched))
+    start = time.time()
+    proc.start()
+    tests = manager(manager_conn)
+    elapsed = time.time() - start
+    proc.join()
+    return tests / elapsed
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    for batched in (False, True):
+        print("{:>9}: {:10.0f} tests/second".format(
+            "batched" if batched else "unbatched", run(count, batched)))
+
+
+if __name__ == '__main__':
+    main()
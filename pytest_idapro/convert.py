@@ -0,0 +1,39 @@
+"""
+Convert pytest-idapro recordings between the supported records formats. Any
+recording accepted by --ida-replay can be converted to json, jsonl, indexed or
+binary records.
+"""
+
+import argparse
+
+from .idapro_internal import record_module
+from .idapro_internal import replay_module
+
+
+def convert(source, destination, records_format, compression='none'):
+    records = replay_module.load_records(source)
+
+    # make sure lazily loaded records are completely loaded
+    records = {module_name: dict(module_records)
+               for module_name, module_records in records.items()}
+
+    with open(destination, 'wb') as fh:
+        record_module.write_records(records, fh, records_format, compression)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('source', help="Recording file to convert")
+    parser.add_argument('destination', help="Converted recording file")
+    parser.add_argument('--format', choices=('json', 'jsonl', 'indexed',
+                                             'binary'),
+                        default='binary', help="Format to convert to")
+    parser.add_argument('--compression', choices=('none', 'gzip', 'zstd'),
+                        default='none', help="Compression of binary records")
+    args = parser.parse_args(argv)
+
+    convert(args.source, args.destination, args.format, args.compression)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,40 @@
 import ida_auto
+import ida_loader
 
-from multiprocessing.connection import Client
+from . import transport
+
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
 import platform
 import logging
+import sys
+import os
 
 logging.basicConfig()
 log = logging.getLogger('pytest-idapro.internal.worker')
 
 
 class IdaWorker(object):
-    def __init__(self, conn_addr, *args, **kwargs):
+    def __init__(self, conn_addr, daemon=False, authkey=None, *args,
+                 **kwargs):
         super(IdaWorker, self).__init__(*args, **kwargs)
-        self.daemon = True
-        self.conn = Client(conn_addr)
+        if daemon:
+            # a socket file may be left behind by a previous daemon
+            if not conn_addr.startswith('\\\\') and os.path.exists(conn_addr):
+                os.unlink(conn_addr)
+            self.listener = Listener(conn_addr, authkey=authkey)
+            self.conn = None
+        else:
+            self.listener = None
+            self.conn = Client(conn_addr)
+        self.sender = transport.BatchSender(self.conn)
         self.stop = False
         self.quit_ida = True
         self.pytest_config = None
         from PyQt5.QtWidgets import qApp
         self.qapp = qApp
+        self.notifier = None
+        self.notifier_loop = None
 
     def run(self):
         try:
@@ -25,25 +42,93 @@ class IdaWorker(object):
                 command = self.recv()
                 response = self.handle_command(*command)
                 if response:
-                    self.conn.send(response)
+                    self.sender.send(response)
         except RuntimeError:
             log.exception("Runtime error encountered during message handling")
         except EOFError:
             log.info("remote connection closed abruptly, terminating.")
-            self.quit_ida = True
+            # a daemon outlives its managers
+            self.quit_ida = self.listener is None
 
         return self.quit_ida
 
+    def serve(self):
+        """Serve test sessions of managers connecting to the listener, one at
+        a time, until a manager requests quitting IDA"""
+        while True:
+            try:
+                self.conn = self.listener.accept()
+            except AuthenticationError:
+                log.warning("Rejected a connection with a wrong "
+                            "authentication key")
+                continue
+            self.sender = transport.BatchSender(self.conn)
+            self.stop = False
+            self.quit_ida = False
+
+            modules = set(sys.modules)
+            path = list(sys.path)
+            quit_ida = self.run()
+            self.conn.close()
+            # the notifier watches the closed connection
+            self.notifier = None
+            self.reset(modules, path)
+
+            if quit_ida:
+                break
+
+        self.listener.close()
+        return True
+
+    def reset(self, modules, path):
+        """Forget test and plugin modules imported during a test session, so
+        that the next session imports them again with any changes made"""
+        if self.pytest_config:
+            rootdir = os.path.join(str(self.pytest_config.rootdir), '')
+            for name in set(sys.modules) - modules:
+                module_file = getattr(sys.modules[name], '__file__', None)
+                if (module_file and
+                    os.path.abspath(module_file).startswith(rootdir)):
+                    del sys.modules[name]
+        sys.path[:] = path
+        self.pytest_config = None
+
     def recv(self):
         while not self.stop:
+            if self.conn.poll():
+                return self.conn.recv()
+
+            self.wait_readable()
+
+    def wait_readable(self):
+        """Process Qt events until the connection becomes readable"""
+        # windows pipe handles cannot be watched by a QSocketNotifier
+        if platform.system() == "Windows":
             self.qapp.processEvents()
-            if not self.conn.poll(1):
-                continue
+            self.conn.poll(0.01)
+            return
 
-            return self.conn.recv()
+        from PyQt5.QtCore import QEventLoop, QSocketNotifier
+        if self.notifier is None:
+            self.notifier_loop = QEventLoop()
+            self.notifier = QSocketNotifier(self.conn.fileno(),
+                                            QSocketNotifier.Read)
+            self.notifier.activated.connect(self.notifier_loop.quit)
+
+        self.notifier.setEnabled(True)
+        self.notifier_loop.exec_()
+        self.notifier.setEnabled(False)
 
     def send(self, *s):
-        return self.conn.send(s)
+        return self.sender.send(s)
+
+    def send_batched(self, *s):
+        """Send a message that may be delayed and coalesced with following
+        ones, see transport.BatchSender"""
+        return self.sender.send_batched(s)
+
+    def batch_boundary(self):
+        self.sender.boundary()
 
     def handle_command(self, command, *command_args):
         handler_name = "command_" + command
@@ -142,7 +227,7 @@ class IdaWorker(object):
         return ("quitting",)
 
     @staticmethod
-    def command_save_records(dest_file):
+    def command_save_records(dest_file, records_format, compression):
         # we have to fetch record_module manually because of how it was loaded
         # from ida's python/init.py
         import sys
@@ -150,5 +235,32 @@ class IdaWorker(object):
             return ('save_records', 'failed')
         record_module = sys.modules['record_module']
 
-        record_module.dump_records(dest_file)
+        record_module.dump_records(dest_file, records_format, compression)
         return ('save_records', 'done')
+
+    @staticmethod
+    def command_save_profile(dest_file):
+        import sys
+        if 'record_module' not in sys.modules:
+            return ('save_profile', 'failed')
+        record_module = sys.modules['record_module']
+
+        record_module.dump_profile(dest_file)
+        return ('save_profile', 'done')
+
+    @staticmethod
+    def command_save_database(dest_file):
+        # keep the extension of the current database, which depends on the
+        # bitness of IDA used
+        idb_path = ida_loader.get_path(ida_loader.PATH_TYPE_IDB)
+        dest_file += os.path.splitext(idb_path)[1]
+
+        # save a compacted copy, the manager moves it into the cache once
+        # saved so it must not become the database IDA is working on
+        if not ida_loader.save_database(dest_file, ida_loader.DBFL_COMP):
+            return ('save_database', 'failed')
+        if ida_loader.get_path(ida_loader.PATH_TYPE_IDB) != idb_path:
+            log.warning("IDA switched to the saved database %s, not caching "
+                        "it", dest_file)
+            return ('save_database', 'failed')
+        return ('save_database', 'done', dest_file)
@@ -2,13 +2,183 @@ import os
 import sys
 import types
 import inspect
+import linecache
 import json
 import logging
+import struct
+import gzip
 import re
+import time
+import fnmatch
+import contextlib
+
+
+class RecordDict(dict):
+    """A dictionary of records. Once attached to the records tree while
+    streaming, every item set is written to the records stream as well"""
+    __slots__ = ('path', 'calls')
+
+    def __init__(self, *args, **kwargs):
+        super(RecordDict, self).__init__(*args, **kwargs)
+        self.path = None
+        # identical calls recorded in this dictionary's call data, which is
+        # kept in memory only
+        self.calls = None
+
+    def __setitem__(self, key, value):
+        if g_stream is not None and self.path is not None:
+            # avoid repeatedly streaming values that did not change, such as
+            # attributes read over and over again
+            if (isinstance(value, (RecordDict, RecordList)) or
+                key not in self or self[key] != value):
+                stream_event(['s', self.path, key, value])
+                attach_record(value, self.path + [key])
+        super(RecordDict, self).__setitem__(key, value)
+
+
+class RecordList(list):
+    """A list of records. Once attached to the records tree while streaming,
+    appended items are written to the records stream instead of being kept
+    in memory"""
+    __slots__ = ('path', 'length')
+
+    def __init__(self, *args, **kwargs):
+        super(RecordList, self).__init__(*args, **kwargs)
+        self.path = None
+        self.length = 0
+
+    def append(self, value):
+        if g_stream is not None and self.path is not None:
+            stream_event(['a', self.path, value])
+            attach_record(value, self.path + [self.length])
+            self.length += 1
+        else:
+            super(RecordList, self).append(value)
+
+    def __setitem__(self, index, value):
+        if g_stream is not None and self.path is not None:
+            stream_event(['s', self.path, index, value])
+        else:
+            super(RecordList, self).__setitem__(index, value)
+
+
+class CallIndices(object):
+    """Call indices of identical calls sharing a single recorded call
+    description. Indices are kept in the description's call_indices as a
+    list of [first call index, number of consecutive calls] runs"""
+    __slots__ = ('desc', 'runs', 'start', 'count', 'position')
+
+    def __init__(self, desc):
+        self.desc = desc
+        self.runs = None
+        self.start = desc['call_index']
+        self.count = 1
+        self.position = 0
+
+    def add(self, call_index):
+        if self.runs is None:
+            self.runs = RecordList()
+            self.desc['call_indices'] = self.runs
+            self.runs.append([self.start, self.count])
+
+        if call_index == self.start + self.count:
+            self.count += 1
+            self.runs[self.position] = [self.start, self.count]
+        else:
+            self.start = call_index
+            self.count = 1
+            self.runs.append([self.start, self.count])
+            self.position += 1
+
+
+# Maximal number of distinct calls of a single function that later identical
+# calls are deduplicated into
+CALL_DEDUP_MAX = 4096
+
+
+def freeze_value(o):
+    """Convert a recorded value to a hashable representation, raising
+    TypeError for values of other types, such as objects that are only
+    recorded by their repr. Booleans and floats are kept apart from equal
+    integers"""
+    t = type(o)
+    if t in freeze_scalar_types:
+        return o
+    elif t is list or t is tuple or t is RecordList:
+        return tuple([freeze_value(v) for v in o])
+    elif t is dict or t is RecordDict:
+        # tagged so it is not mistaken for a sequence of pairs
+        return dict, tuple([(k, freeze_value(v)) for k, v in o.items()])
+    elif t is bool or t is float:
+        return t, o
+    raise TypeError("Unsupported value type", t)
+
+
+def call_key(call_desc):
+    """Identify a recorded call by its arguments, callstack and result, or
+    return None for calls that can not be deduplicated, such as calls
+    returning objects or calling callbacks"""
+    if call_desc['callback']:
+        return None
+    result = call_desc.get('retval', call_desc.get('exception'))
+    if (not isinstance(result, dict) or
+        result.get('value_type') not in ('value', 'exception')):
+        return None
+
+    # a caller's file and line also identify its source text
+    callstack = tuple([(cs['caller_file'], cs['caller_line'],
+                        cs['caller_function'])
+                       for cs in call_desc['callstack']])
+    try:
+        return (freeze_value(call_desc['args']),
+                freeze_value(call_desc['kwargs']), callstack,
+                freeze_value(result))
+    except TypeError:
+        return None
+
+
+def record_call(records, call_desc):
+    """Add a completed call to the call data of records. Calls identical to
+    an already recorded call only add their call index to it"""
+    key = call_key(call_desc)
+    if key is not None and records.calls is not None:
+        call_indices = records.calls.get(key)
+        if call_indices is not None:
+            call_indices.add(call_desc['call_index'])
+            return
+
+    # TODO: can this be united with instance's call to init_record?
+    records['call_data'].append(RecordDict(instance_desc=call_desc))
+    if key is not None:
+        if records.calls is None:
+            records.calls = {}
+        # bound memory kept for functions called with ever changing arguments
+        if len(records.calls) < CALL_DEDUP_MAX:
+            records.calls[key] = CallIndices(call_desc)
+
+
+def attach_record(value, path):
+    """Assign stream paths to a record and all records nested in it, as they
+    were just written to the records stream"""
+    if isinstance(value, RecordDict):
+        value.path = path
+        for k, v in value.items():
+            attach_record(v, path + [k])
+    elif isinstance(value, RecordList):
+        value.path = path
+        for i, v in enumerate(value):
+            attach_record(v, path + [i])
+        value.length = len(value)
+        del value[:]
+
+
+def stream_event(event):
+    records = json.dumps(event, cls=RecordJSONEncoder)
+    g_stream.write(normalize_records(records) + "\n")
 
 
 # A global variable holding all collected recordings
-g_records = {}
+g_records = RecordDict()
 
 # A global variable holding all proxied classes by name, to prevent defining
 # the same class more than once
@@ -18,27 +188,246 @@ g_classes = {}
 # setup
 g_paths_re = None
 
+# A global file object all record modifications are written to as they happen
+# when streaming records, it'll be assigned by setup
+g_stream = None
+
+# Maximal number of recorded callstack frames and whether the source line of
+# every frame is recorded, they'll be assigned by setup
+g_callstack_depth = None
+g_caller_text = False
+
+# Whether calls are recorded and the profiler of calls when profiling,
+# they'll be assigned by setup
+g_recording = True
+g_profiler = None
+
+# Filters of recorded APIs for the whole session and for the running test,
+# they'll be assigned by setup and by the idapro_record marker
+g_record_filter = None
+g_test_filter = None
+
+# The first line of a records stream, identifying a stream records file
+STREAM_HEADER = ["pytest-idapro", "stream", 1]
+
+# The first bytes of an indexed records file, followed by the offset of the
+# records index
+INDEXED_MAGIC = b'IDAPRIDX'
+
+# The first bytes of a binary records file, followed by a single compression
+# byte, one of BINARY_COMPRESSIONS' values
+BINARY_MAGIC = b'IDAPRBIN'
+BINARY_COMPRESSIONS = {'none': 0, 'gzip': 1, 'zstd': 2}
+
+# Binary records value tags
+(BINARY_NONE, BINARY_FALSE, BINARY_TRUE, BINARY_INT, BINARY_FLOAT,
+ BINARY_STR_NEW, BINARY_STR_REF, BINARY_STR_RAW, BINARY_LIST,
+ BINARY_DICT) = range(10)
+
+# Strings longer than this are not interned in binary records
+BINARY_INTERN_MAX = 128
+
 
 def logger():
     return logging.getLogger('pytest_idapro.internal.record')
 
 
-def dump_records(records_file):
-    # use our speciallized json enocoder to dump all collected records to json
-    records = json.dumps(g_records, cls=RecordJSONEncoder)
-    records = g_paths_re.sub('', records)
-    records = re.sub(' at 0x[0-9a-fA-F]{1,16}>', '>', records)
+def normalize_records(records):
+    """Strip base paths and memory addresses from serialized records"""
+    if g_paths_re:
+        records = g_paths_re.sub('', records)
+    return re.sub(' at 0x[0-9a-fA-F]{1,16}>', '>', records)
+
+
+def dump_records(records_file, records_format='json', compression='none'):
+    if g_stream is not None:
+        # records were already written as they were recorded
+        g_stream.flush()
+        return
 
     with open(records_file, 'wb') as fh:
-        fh.write(records)
+        write_records(g_records, fh, records_format, compression)
+
+
+def write_records(records, fh, records_format='json', compression='none'):
+    if records_format == 'indexed':
+        write_records_indexed(records, fh)
+    elif records_format == 'jsonl':
+        write_records_stream(records, fh)
+    elif records_format == 'binary':
+        write_records_binary(records, fh, compression)
+    elif records_format == 'json':
+        write_records_json(records, fh)
+    else:
+        raise ValueError("Unsupported records format", records_format)
 
 
-def setup(base_paths):
+def write_records_json(records, fh):
+    # use our speciallized json enocoder to dump all collected records to json
+    records = json.dumps(records, cls=RecordJSONEncoder)
+    fh.write(normalize_records(records).encode('utf-8'))
+
+
+def write_records_indexed(records, fh):
+    """Write records so that every module attribute's record is serialized
+    separately, followed by an index of all serialized records' offsets and
+    lengths by module and attribute names. This lets a replay session only
+    deserialize records of attributes that are actually used"""
+    fh.write(INDEXED_MAGIC + struct.pack('<Q', 0))
+
+    index = {}
+    for module_name, module_records in records.items():
+        module_index = index[module_name] = {}
+        for name, record in module_records.items():
+            data = json.dumps(record, cls=RecordJSONEncoder)
+            data = normalize_records(data).encode('utf-8')
+            module_index[name] = (fh.tell(), len(data))
+            fh.write(data)
+
+    index_offset = fh.tell()
+    fh.write(json.dumps(index).encode('utf-8'))
+    fh.seek(len(INDEXED_MAGIC))
+    fh.write(struct.pack('<Q', index_offset))
+
+
+def write_records_stream(records, fh):
+    """Write records that were already collected as a records stream, setting
+    every module's records at once"""
+    fh.write((json.dumps(STREAM_HEADER) + "\n").encode('utf-8'))
+    for module_name, module_records in records.items():
+        data = json.dumps(['s', [], module_name, module_records],
+                          cls=RecordJSONEncoder)
+        fh.write((normalize_records(data) + "\n").encode('utf-8'))
+
+
+def write_records_binary(records, fh, compression='none'):
+    if compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            logger().warning("zstandard is unavailable, compressing binary "
+                             "records with gzip instead")
+            compression = 'gzip'
+
+    fh.write(BINARY_MAGIC + struct.pack('B', BINARY_COMPRESSIONS[compression]))
+    if compression == 'gzip':
+        with gzip.GzipFile(fileobj=fh, mode='wb') as compressed_fh:
+            BinaryRecordsWriter(compressed_fh).write(records)
+    elif compression == 'zstd':
+        compressed_fh = zstandard.ZstdCompressor().stream_writer(fh)
+        BinaryRecordsWriter(compressed_fh).write(records)
+        compressed_fh.flush(zstandard.FLUSH_FRAME)
+    else:
+        BinaryRecordsWriter(fh).write(records)
+
+
+class BinaryRecordsWriter(object):
+    """Write records in a compact binary encoding, similar to msgpack. Every
+    short string (such as keys, file and function names) is written once and
+    afterwards referenced by the order in which it was first written"""
+
+    def __init__(self, fh):
+        self.fh = fh
+        self.buf = bytearray()
+        self.strings = {}
+        self.encoder = RecordJSONEncoder()
+
+    def write(self, records):
+        self.write_value(records)
+        self.fh.write(bytes(self.buf))
+        self.buf = bytearray()
+
+    def write_varint(self, n):
+        while n >= 0x80:
+            self.buf.append((n & 0x7f) | 0x80)
+            n >>= 7
+        self.buf.append(n)
+
+    def write_str(self, o):
+        o = normalize_records(o)
+        if o in self.strings:
+            self.buf.append(BINARY_STR_REF)
+            self.write_varint(self.strings[o])
+            return
+
+        data = o.encode('utf-8') if not isinstance(o, bytes) else o
+        if len(data) <= BINARY_INTERN_MAX:
+            self.strings[o] = len(self.strings)
+            self.buf.append(BINARY_STR_NEW)
+        else:
+            self.buf.append(BINARY_STR_RAW)
+        self.write_varint(len(data))
+        self.buf.extend(data)
+
+    def write_value(self, o):
+        if o is None:
+            self.buf.append(BINARY_NONE)
+        elif o is False:
+            self.buf.append(BINARY_FALSE)
+        elif o is True:
+            self.buf.append(BINARY_TRUE)
+        elif isinstance(o, int_types):
+            self.buf.append(BINARY_INT)
+            # zigzag encode to keep small negative numbers short
+            self.write_varint(o * 2 if o >= 0 else -o * 2 - 1)
+        elif isinstance(o, float):
+            self.buf.append(BINARY_FLOAT)
+            self.buf.extend(struct.pack('<d', o))
+        elif isinstance(o, str_types):
+            self.write_str(o)
+        elif isinstance(o, (list, tuple)):
+            self.buf.append(BINARY_LIST)
+            self.write_varint(len(o))
+            for v in o:
+                self.write_value(v)
+        elif isinstance(o, dict):
+            self.buf.append(BINARY_DICT)
+            self.write_varint(len(o))
+            for k, v in o.items():
+                # keys are converted to strings, the same way json does
+                if not isinstance(k, str_types):
+                    k = json.dumps(k)
+                self.write_str(k)
+                self.write_value(v)
+        else:
+            self.write_value(self.encoder.default(o))
+
+        if len(self.buf) > 0x10000:
+            self.fh.write(bytes(self.buf))
+            self.buf = bytearray()
+
+
+def setup(base_paths, stream_file=None, callstack_depth=None,
+          caller_text=False, record=True, profile=False, include=(),
+          exclude=()):
     global g_paths_re
+    global g_stream
+    global g_callstack_depth
+    global g_caller_text
+    global g_recording
+    global g_profiler
+    global g_record_filter
 
     # define the global paths regex
     g_paths_re = re.compile('({})'.format("|".join(base_paths)))
 
+    g_callstack_depth = callstack_depth
+    g_caller_text = caller_text
+
+    # when only profiling, calls are wrapped but their records are discarded
+    g_recording = record
+    if profile:
+        g_profiler = CallProfiler()
+    if include or exclude:
+        g_record_filter = RecordFilter(include, exclude)
+
+    # when streaming, all modifications of the records tree are written to
+    # stream_file as json lines instead of keeping them in memory
+    if stream_file:
+        g_stream = open(stream_file, 'w', 1)
+        g_stream.write(json.dumps(STREAM_HEADER) + "\n")
+        g_records.path = []
+
     # install a module loader to inject a record module wrapper instead of IDA
     # modules
     sys.meta_path.insert(0, RecordModuleLoader())
@@ -55,6 +444,202 @@ def is_idamodule(fullname):
     return False
 
 
+# Distinct arguments are only counted up to this many per API
+PROFILE_MAX_ARGUMENTS = 1 << 16
+
+# A timer of the highest available resolution
+timer = getattr(time, 'perf_counter', time.time)
+
+
+def api_name(subject, name):
+    module = getattr(subject, '__module__', None)
+    name = getattr(subject, '__qualname__', name)
+    return "{}.{}".format(module, name) if module else name
+
+
+def arguments_key(args, kwargs):
+    try:
+        return hash((args, tuple(sorted(kwargs.items()))))
+    except TypeError:
+        return hash(repr((args, kwargs)))
+
+
+def profile_caller():
+    """Name of the closest frame calling into IDA that is not part of IDA's
+    python modules or of the record module"""
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if not (os.path.splitext(filename)[0] ==
+                os.path.splitext(__file__)[0] or
+                is_idamodule(os.path.basename(filename))):
+            return "{}:{}".format(os.path.basename(filename),
+                                  frame.f_code.co_name)
+        frame = frame.f_back
+    return "<unknown>"
+
+
+class CallProfiler(object):
+    """Accumulates the number of calls, cumulative and self wall time and
+    number of distinct arguments of every recorded API. Self time excludes
+    time spent in nested API calls, such as APIs called by idautils or by
+    callbacks. Self time is also accumulated by callstack, starting with the
+    function that made the outermost API call, for flamegraphs"""
+    def __init__(self):
+        # API name -> [calls, cumulative time, self time, argument keys]
+        self.apis = {}
+        self.stacks = {}
+        # currently running calls as [name, start time, nested calls' time]
+        self.running = []
+        self.caller = None
+
+    def enter(self, subject, name, args, kwargs):
+        name = api_name(subject, name)
+        stats = self.apis.get(name)
+        if stats is None:
+            stats = self.apis[name] = [0, 0.0, 0.0, set()]
+        stats[0] += 1
+        if len(stats[3]) < PROFILE_MAX_ARGUMENTS:
+            stats[3].add(arguments_key(args, kwargs))
+
+        if not self.running:
+            self.caller = profile_caller()
+        self.running.append([name, timer(), 0.0])
+
+    def exit(self):
+        name, start, nested_time = self.running[-1]
+        elapsed = timer() - start
+        self_time = elapsed - nested_time
+
+        stats = self.apis[name]
+        # recursive calls are already accounted for by the outermost call
+        if not any(r[0] == name for r in self.running[:-1]):
+            stats[1] += elapsed
+        stats[2] += self_time
+
+        stack = ";".join([self.caller] + [r[0] for r in self.running])
+        self.stacks[stack] = self.stacks.get(stack, 0.0) + self_time
+
+        self.running.pop()
+        if self.running:
+            self.running[-1][2] += elapsed
+
+    def report(self):
+        apis = [{'name': name, 'calls': calls, 'cumulative': cumulative,
+                 'self': self_time, 'distinct_args': len(args),
+                 'distinct_args_capped': len(args) >= PROFILE_MAX_ARGUMENTS}
+                for name, (calls, cumulative, self_time, args)
+                in self.apis.items()]
+        return {'version': 1, 'apis': apis, 'stacks': self.stacks}
+
+
+def dump_profile(profile_file):
+    """Write the profile as JSON to profile_file, and its callstacks in the
+    collapsed format used by flamegraph tools to profile_file.collapsed,
+    weighted by self time in microseconds"""
+    report = g_profiler.report()
+    with open(profile_file, 'w') as fh:
+        json.dump(report, fh, indent=1)
+
+    with open(profile_file + ".collapsed", 'w') as fh:
+        for stack, self_time in sorted(report['stacks'].items()):
+            fh.write("{} {}\n".format(stack, int(self_time * 1000000)))
+
+
+PROFILE_SORT_KEYS = ('self', 'cumulative', 'calls', 'distinct_args')
+
+
+def format_profile(report, sort_key='self', limit=None):
+    """Format a profile report as lines of a text table, sorted by sort_key
+    in descending order"""
+    apis = sorted(report['apis'], key=lambda api: api[sort_key],
+                  reverse=True)
+    if limit is not None:
+        apis = apis[:limit]
+
+    lines = ["{:>10} {:>12} {:>12} {:>10} {:>9}  {}".format(
+        "calls", "cumulative", "self", "per call", "args", "api")]
+    for api in apis:
+        lines.append("{:>10} {:>11.3f}s {:>11.3f}s {:>8.1f}us {:>8}{}  "
+                     "{}".format(api['calls'], api['cumulative'],
+                                 api['self'],
+                                 api['self'] / api['calls'] * 1000000,
+                                 api['distinct_args'],
+                                 "+" if api['distinct_args_capped'] else " ",
+                                 api['name']))
+    return lines
+
+
+class RecordFilter(object):
+    """Selects recorded APIs using glob patterns over module.name, where a
+    pattern without a dot matches a whole module. An API is recorded if it
+    matches any of the include patterns, or none are provided, and matches
+    none of the exclude patterns"""
+    def __init__(self, include=(), exclude=()):
+        self.include = [self.split(p) for p in self.patterns(include)]
+        self.exclude = [self.split(p) for p in self.patterns(exclude)]
+        self.decisions = {}
+
+    @staticmethod
+    def patterns(patterns):
+        if isinstance(patterns, str_types):
+            return [patterns]
+        return patterns or ()
+
+    @staticmethod
+    def split(pattern):
+        if '.' not in pattern:
+            return pattern, '*'
+        return tuple(pattern.split('.', 1))
+
+    def module_recorded(self, module):
+        if (self.include and
+            not any(fnmatch.fnmatchcase(module, m) for m, _ in self.include)):
+            return False
+        return not any(fnmatch.fnmatchcase(module, m) and n == '*'
+                       for m, n in self.exclude)
+
+    def match(self, module, name):
+        def matches(patterns):
+            return any(fnmatch.fnmatchcase(module, m) and
+                       fnmatch.fnmatchcase(name, n) for m, n in patterns)
+
+        if self.include and not matches(self.include):
+            return False
+        return not matches(self.exclude)
+
+    def recorded(self, module, name):
+        key = (module, name)
+        decision = self.decisions.get(key)
+        if decision is None:
+            decision = self.decisions[key] = self.match(module, name)
+        return decision
+
+    def attribute_recorded(self, module, name, value):
+        """Whether a module attribute is recorded, also matching the module
+        it is defined in, such as ida_bytes.get_byte for idaapi.get_byte"""
+        if not self.recorded(module, name):
+            return False
+        value_module = getattr(value, '__module__', None)
+        if (isinstance(value_module, str_types) and value_module != module and
+            is_idamodule(value_module)):
+            return self.recorded(value_module, name)
+        return True
+
+
+@contextlib.contextmanager
+def filtered(include=(), exclude=()):
+    """Only record calls selected by include and exclude patterns, in
+    addition to the session's filter, until done"""
+    global g_test_filter
+
+    g_test_filter = RecordFilter(include, exclude)
+    try:
+        yield g_test_filter
+    finally:
+        g_test_filter = None
+
+
 class RecordModuleLoader(object):
     def __init__(self):
         super(RecordModuleLoader, self).__init__()
@@ -88,6 +673,12 @@ class RecordModuleLoader(object):
         if fullname.startswith("idc_"):
             fullname = "idc"
 
+        # modules that are not recorded at all are not wrapped either
+        if (g_record_filter is not None and
+            not g_record_filter.module_recorded(fullname)):
+            sys.modules[fullname] = real_module
+            return real_module
+
         record = record_factory(fullname, real_module, g_records)
         sys.modules[fullname] = record
 
@@ -99,10 +690,15 @@ try:
     base_types += (unicode, long, types.NoneType)
     str_types = (str, unicode)
     int_types = (int, long)
+    old_instance_types = (types.InstanceType,)
 except NameError:
     base_types += (type(None),)
     str_types = (str,)
     int_types = (int,)
+    old_instance_types = ()
+
+# types freeze_value keeps as they are, matched exactly to tell bool apart
+freeze_scalar_types = frozenset(str_types + int_types + (bytes, type(None)))
 
 
 def call_prepare_records(o, pr):
@@ -162,9 +758,9 @@ class RecordJSONEncoder(json.JSONEncoder):
                 return cls.__subject_name__ + ";" + repr(o)
             else:
                 return cls.__name__ + ";" + repr(o)
-        elif (isinstance(o, type) or isinstance(o, types.InstanceType) or
+        elif (isinstance(o, type) or isinstance(o, old_instance_types) or
               inspect.isbuiltin(o) or isinstance(o, types.ModuleType) or
-              isinstance(o, types.InstanceType) or inspect.isclass(o) or
+              isinstance(o, old_instance_types) or inspect.isclass(o) or
               inspect.isfunction(o)):
             return repr(o)
 
@@ -176,19 +772,32 @@ class RecordJSONEncoder(json.JSONEncoder):
 
 
 def record_callstack():
-    if len(inspect.stack()) <= 2:
+    # walk frames directly instead of using inspect.stack(), which reads
+    # source lines of all frames
+    try:
+        frame = sys._getframe(2)
+    except ValueError:
         return []
 
     callstack_records = []
-    for cs in inspect.stack()[2:]:
-        if cs[3].startswith('pytest_'):
+    while frame is not None:
+        if len(callstack_records) == g_callstack_depth:
             break
-        if not (is_idamodule(os.path.basename(cs[1])) or
-                '/_pytest/' in cs[1] or '/pytestqt/' in cs[1] or
-                '/pytest_idapro/' in cs[1] or '/python2.7/' in cs[1]):
-            record = {'caller_file': cs[1], 'caller_line': cs[2],
-                      'caller_function': cs[3], 'caller_text': cs[4]}
+
+        filename = frame.f_code.co_filename
+        function = frame.f_code.co_name
+        if function.startswith('pytest_'):
+            break
+        if not (is_idamodule(os.path.basename(filename)) or
+                '/_pytest/' in filename or '/pytestqt/' in filename or
+                '/pytest_idapro/' in filename or '/python2.7/' in filename):
+            caller_text = None
+            if g_caller_text:
+                caller_text = [linecache.getline(filename, frame.f_lineno)]
+            record = {'caller_file': filename, 'caller_line': frame.f_lineno,
+                      'caller_function': function, 'caller_text': caller_text}
             callstack_records.append(record)
+        frame = frame.f_back
     return callstack_records
 
 
@@ -197,8 +806,10 @@ def init_record(record, subject, records, name, data_type=None):
     record.__subject_name__ = name
 
     if name is None:
-        record.__records__ = {'value_type': record.__value_type__}
-        records.setdefault(data_type, []).append(record.__records__)
+        record.__records__ = RecordDict(value_type=record.__value_type__)
+        if data_type not in records:
+            records[data_type] = RecordList()
+        records[data_type].append(record.__records__)
     elif name in records:
         record.__records__ = records[name]
         if record.__records__['value_type'] != record.__value_type__:
@@ -206,13 +817,23 @@ def init_record(record, subject, records, name, data_type=None):
                                record.__value_type__, "!=",
                                record.__records__['value_type'])
     else:
-        record.__records__ = {'value_type': record.__value_type__}
+        record.__records__ = RecordDict(value_type=record.__value_type__)
         records[name] = record.__records__
     return record
 
 
 oga = object.__getattribute__
 
+# Attributes of records themselves, rather than of their recorded subjects
+RECORD_ATTRIBUTES = frozenset(('__subject__', '__records__',
+                               '__subject_name__', '__value_type__'))
+RECORD_CLASS_ATTRIBUTES = RECORD_ATTRIBUTES | {'__instance_records__'}
+
+# How record_factory handles values of an attribute, cached by the types of
+# the attribute's owner and value, and the attribute's name
+ATTRIBUTE_IGNORE, ATTRIBUTE_VALUE, ATTRIBUTE_RECORD = range(3)
+g_attribute_decisions = {}
+
 
 def ignore_object(obj):
     if isinstance(obj, AbstractRecord):
@@ -234,6 +855,43 @@ def ignore_object(obj):
     return False
 
 
+def attribute_decision(owner_type, name, value):
+    # attributes of recorded classes' instances are recorded by the class
+    if getattr(owner_type, '__value_type__', None) == 'class':
+        return ATTRIBUTE_IGNORE
+    # handling of classes, functions and modules depends on the value itself
+    # and not only on its type, always pass them to record_factory
+    elif (inspect.isclass(value) or
+          isinstance(value, (types.ModuleType, types.FunctionType,
+                             types.MethodType))):
+        return ATTRIBUTE_RECORD
+    elif ignore_object(value):
+        return ATTRIBUTE_IGNORE
+    elif (isinstance(value, (BaseException,) + old_instance_types) or
+          not isinstance(value, base_types)):
+        return ATTRIBUTE_RECORD
+    elif name == '__dict__':
+        return ATTRIBUTE_IGNORE
+    return ATTRIBUTE_VALUE
+
+
+def record_attribute(owner_type, name, value, parent_record):
+    """Equivalent to record_factory for attribute values, avoiding repeating
+    the inspection of values of the same attribute and type"""
+    key = (owner_type, name, type(value))
+    decision = g_attribute_decisions.get(key)
+    if decision is None:
+        decision = attribute_decision(owner_type, name, value)
+        g_attribute_decisions[key] = decision
+
+    if decision == ATTRIBUTE_IGNORE:
+        return value
+    elif decision == ATTRIBUTE_VALUE:
+        parent_record[name] = {'value_type': 'value', 'raw_data': value}
+        return value
+    return record_factory(name, value, parent_record)
+
+
 def record_factory(name, value, parent_record, force=False):
     if not force and ignore_object(value):
         return value
@@ -253,25 +911,39 @@ def record_factory(name, value, parent_record, force=False):
             __value_type__ = 'class'
 
             def __new__(cls, *args, **kwargs):
-                obj = super(RecordClass, cls).__new__(cls, *args, **kwargs)
-
-                r = init_record(InstanceRecord(), obj, parent_record[name],
-                                None, 'instance_data')
-                init_desc = {}
-                init_desc['args'] = args
-                init_desc['kwargs'] = kwargs
-                if cls.__name__ == 'RecordClass':
-                    init_desc['name'] = cls.__subject_name__
+                new = super(RecordClass, cls).__new__
+                # object.__new__ does not accept the arguments passed to
+                # __init__ in python3
+                if new is object.__new__:
+                    obj = new(cls)
                 else:
-                    init_desc['name'] = cls.__name__
-                init_desc['callstack'] = record_callstack()
-                r.__records__['instance_desc'] = init_desc
+                    obj = new(cls, *args, **kwargs)
 
-                if 'call_count' not in parent_record[name]:
-                    parent_record[name]['call_count'] = 0
+                if not g_recording:
+                    # instances are still wrapped so that calls to their
+                    # methods are profiled, but are not kept in the records
+                    r = init_record(InstanceRecord(), obj, RecordDict(), None,
+                                    'instance_data')
                 else:
-                    parent_record[name]['call_count'] += 1
-                init_desc['call_index'] = parent_record[name]['call_count']
+                    r = init_record(InstanceRecord(), obj,
+                                    parent_record[name], None,
+                                    'instance_data')
+                    init_desc = RecordDict()
+                    init_desc['args'] = args
+                    init_desc['kwargs'] = kwargs
+                    if cls.__name__ == 'RecordClass':
+                        init_desc['name'] = cls.__subject_name__
+                    else:
+                        init_desc['name'] = cls.__name__
+                    init_desc['callstack'] = record_callstack()
+                    r.__records__['instance_desc'] = init_desc
+
+                    if 'call_count' not in parent_record[name]:
+                        parent_record[name]['call_count'] = 0
+                    else:
+                        parent_record[name]['call_count'] += 1
+                    init_desc['call_index'] = \
+                        parent_record[name]['call_count']
 
                 obj.__instance_records__ = r
 
@@ -285,8 +957,7 @@ def record_factory(name, value, parent_record, force=False):
                 return r
 
             def __getattribute__(self, attr):
-                if attr in ('__subject__', '__records__', '__subject_name__',
-                            '__value_type__', '__instance_records__'):
+                if attr in RECORD_CLASS_ATTRIBUTES:
                     return oga(self, attr)
 
                 try:
@@ -294,9 +965,9 @@ def record_factory(name, value, parent_record, force=False):
                 except AttributeError:
                     r = oga(self, attr)
 
-                r = record_factory(attr, r,
-                                   self.__instance_records__.__records__)
-                return r
+                records = oga(oga(self, '__instance_records__'),
+                              '__records__')
+                return record_attribute(value, attr, r, records)
 
         if name != '__class__':
             g_classes[name] = RecordClass
@@ -305,7 +976,7 @@ def record_factory(name, value, parent_record, force=False):
         if is_idamodule(value.__name__):
             return init_record(ModuleRecord(), value, parent_record, name)
         return value
-    elif isinstance(value, types.InstanceType):
+    elif isinstance(value, old_instance_types):
         return init_record(OldInstanceRecord(), value, parent_record, name)
     elif isinstance(value, base_types):
         if name != '__dict__':
@@ -319,78 +990,98 @@ def record_factory(name, value, parent_record, force=False):
 
 class AbstractRecord(object):
     __value_type__ = "unknown"
+    __slots__ = ('__subject__', '__records__', '__subject_name__',
+                 '__weakref__')
 
     def __call__(self, *args, **kwargs):
-        call_desc = {'args': args,
-                     'kwargs': kwargs,
-                     'name': self.__subject_name__,
-                     'callback': {}}
-
-        # You'd imagine this is always true, right? well.. not in IDA ;)
-        call_desc['callstack'] = record_callstack()
-
-        if 'call_data' not in self.__records__:
-            self.__records__['call_data'] = []
-            self.__records__['call_count'] = 0
-        else:
-            self.__records__['call_count'] += 1
-        call_desc['call_index'] = self.__records__['call_count']
-        # TODO: can this be united with instance's call to init_record?
-        self.__records__['call_data'].append({'instance_desc': call_desc})
+        subject = oga(self, '__subject__')
+        subject_name = oga(self, '__subject_name__')
+        records = oga(self, '__records__')
+        call_desc = RecordDict(args=args,
+                               kwargs=kwargs,
+                               name=subject_name,
+                               callback=RecordDict())
+
+        recording = g_recording
+        if g_test_filter is not None:
+            recording = recording and g_test_filter.recorded(
+                getattr(subject, '__module__', None), subject_name)
+
+        if recording:
+            # You'd imagine this is always true, right? well.. not in IDA ;)
+            call_desc['callstack'] = record_callstack()
+
+            if 'call_data' not in records:
+                records['call_data'] = RecordList()
+                records['call_count'] = 0
+            else:
+                records['call_count'] += 1
+            call_desc['call_index'] = records['call_count']
 
         args = call_prepare_records(args, call_desc)
         kwargs = call_prepare_records(kwargs, call_desc)
+        if g_profiler is not None:
+            g_profiler.enter(subject, subject_name, args, kwargs)
         try:
-            original_retval = self.__subject__(*args, **kwargs)
-        except Exception as ex:
+            original_retval = subject(*args, **kwargs)
+        except BaseException as ex:
             record_factory('exception', ex, call_desc)
+            # calls are recorded once complete, so they can be deduplicated
+            if recording:
+                record_call(records, call_desc)
             raise
+        finally:
+            if g_profiler is not None:
+                g_profiler.exit()
         retval = record_factory('retval', original_retval, call_desc)
+        if recording:
+            record_call(records, call_desc)
         return retval
 
     def __getattribute__(self, attr):
-        if attr in ('__subject__', '__records__', '__subject_name__',
-                    '__value_type__'):
+        if attr in RECORD_ATTRIBUTES:
             return oga(self, attr)
 
-        value = getattr(self.__subject__, attr)
-        processed_value = record_factory(attr, value, self.__records__)
-        return processed_value
+        subject = oga(self, '__subject__')
+        value = getattr(subject, attr)
+        return record_attribute(type(subject), attr, value,
+                                oga(self, '__records__'))
 
     def __setattr__(self, attr, value):
-        if attr in ('__subject__', '__records__', '__subject_name__',
-                    '__value_type__'):
+        if attr in RECORD_ATTRIBUTES:
             object.__setattr__(self, attr, value)
         else:
-            setattr(self.__subject__, attr, value)
+            setattr(oga(self, '__subject__'), attr, value)
 
     def __delattr__(self, attr):
-        delattr(self.__subject__, attr)
+        delattr(oga(self, '__subject__'), attr)
 
+    # special methods are looked up on the type and bypass __getattribute__,
+    # forward them directly to the recorded object without recording
     if hasattr(int, '__nonzero__'):
         def __nonzero__(self):
-            return bool(self.__subject__)
+            return bool(oga(self, '__subject__'))
 
     def __getitem__(self, arg):
-        return self.__subject__[arg]
+        return oga(self, '__subject__')[arg]
 
     def __setitem__(self, arg, val):
-        self.__subject__[arg] = val
+        oga(self, '__subject__')[arg] = val
 
     def __delitem__(self, arg):
-        del self.__subject__[arg]
+        del oga(self, '__subject__')[arg]
 
     def __getslice__(self, i, j):
-        return self.__subject__[i:j]
+        return oga(self, '__subject__')[i:j]
 
     def __setslice__(self, i, j, val):
-        self.__subject__[i:j] = val
+        oga(self, '__subject__')[i:j] = val
 
     def __delslice__(self, i, j):
-        del self.__subject__[i:j]
+        del oga(self, '__subject__')[i:j]
 
     def __contains__(self, ob):
-        return ob in self.__subject__
+        return ob in oga(self, '__subject__')
 
     # Ugly code definitions for all special python methods
     # this will forward all unique method calls to the recorded object
@@ -405,22 +1096,23 @@ class AbstractRecord(object):
                      "from %s import %s" % (name[1], name[0], name[1]))
                 name = name[1]
             exec("def __%s__(self):"
-                 "    return %s(self.__subject__)" % (name, name))
+                 "    return %s(oga(self, '__subject__'))" % (name, name))
 
     for name in 'cmp', 'coerce', 'divmod':
         if hasattr(int, '__%s__' % name):
             exec("def __%s__(self, ob):"
-                 "    return %s(self.__subject__, ob)" % (name, name))
+                 "    return %s(oga(self, '__subject__'), ob)" % (name, name))
 
     for name, op in [
         ('lt', '<'), ('gt', '>'), ('le', '<='), ('ge', '>='),
         ('eq', '=='), ('ne', '!=')
     ]:
         exec("def __%s__(self, ob):"
-             "    return self.__subject__ %s ob" % (name, op))
+             "    return oga(self, '__subject__') %s ob" % (name, op))
 
     for name, op in [('neg', '-'), ('pos', '+'), ('invert', '~')]:
-        exec("def __%s__(self): return %s self.__subject__" % (name, op))
+        exec("def __%s__(self): return %s oga(self, '__subject__')" %
+             (name, op))
 
     for name, op in [('or', '|'), ('and', '&'), ('xor', '^'), ('lshift', '<<'),
                      ('rshift', '>>'), ('add', '+'), ('sub', '-'),
@@ -430,13 +1122,15 @@ class AbstractRecord(object):
             continue
         exec((
             "def __%(name)s__(self, ob):\n"
-            "    return self.__subject__ %(op)s ob\n"
+            "    return oga(self, '__subject__') %(op)s ob\n"
             "\n"
             "def __r%(name)s__(self, ob):\n"
-            "    return ob %(op)s self.__subject__\n"
+            "    return ob %(op)s oga(self, '__subject__')\n"
             "\n"
             "def __i%(name)s__(self, ob):\n"
-            "    self.__subject__ %(op)s=ob\n"
+            "    subject = oga(self, '__subject__')\n"
+            "    subject %(op)s= ob\n"
+            "    object.__setattr__(self, '__subject__', subject)\n"
             "    return self\n"
         ) % locals())
 
@@ -445,29 +1139,48 @@ class AbstractRecord(object):
     # Oddball signatures
 
     def __rdivmod__(self, ob):
-        return divmod(ob, self.__subject__)
+        return divmod(ob, oga(self, '__subject__'))
 
     def __pow__(self, *args):
-        return pow(self.__subject__, *args)
+        return pow(oga(self, '__subject__'), *args)
 
     def __ipow__(self, ob):
-        self.__subject__ **= ob
+        subject = oga(self, '__subject__')
+        subject **= ob
+        object.__setattr__(self, '__subject__', subject)
         return self
 
     def __rpow__(self, ob):
-        return pow(ob, self.__subject__)
+        return pow(ob, oga(self, '__subject__'))
 
 
 class ModuleRecord(AbstractRecord):
     __value_type__ = "module"
+    __slots__ = ()
+
+    def __getattribute__(self, attr):
+        if attr in RECORD_ATTRIBUTES:
+            return oga(self, attr)
+
+        subject = oga(self, '__subject__')
+        value = getattr(subject, attr)
+        # filtered out attributes are returned unwrapped
+        if (g_record_filter is not None and
+            not g_record_filter.attribute_recorded(
+                oga(self, '__subject_name__'), attr, value)):
+            return value
+        return record_attribute(type(subject), attr, value,
+                                oga(self, '__records__'))
 
 
 class FunctionRecord(AbstractRecord):
     __value_type__ = "function"
+    __slots__ = ()
 
 
 class InstanceRecord(AbstractRecord):
     __value_type__ = "instance"
+    __slots__ = ()
 
     def __getattribute__(self, attr):
         try:
@@ -478,3 +1191,4 @@ class InstanceRecord(AbstractRecord):
 
 class OldInstanceRecord(AbstractRecord):
     __value_type__ = 'oldinstance'
+    __slots__ = ()
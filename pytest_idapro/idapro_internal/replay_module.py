@@ -1,5 +1,11 @@
+import sys
+import bisect
 import inspect
 import logging
+import struct
+import json
+import mmap
+import zlib
 import re
 
 try:
@@ -7,19 +13,254 @@ try:
 except ImportError:
     import builtins as exceptions
 
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
+from . import record_module as rm
+
 
 # A global regex matching base paths to be stripped, it'll be assigned by
 # setup
 g_paths_re = None
 
+# A global replay mode, either 'score' to match every call by scoring recorded
+# instances or 'sequential' to expect calls in recorded order. it'll be
+# assigned by setup
+g_replay_mode = 'score'
+
+# Maximal number of callstack frames used for matching, it'll be assigned by
+# setup
+g_callstack_depth = None
+
+# Default maximal number of distinct recorded calls memoized for every pure
+# API
+DEFAULT_MEMO_SIZE = 4096
+
+# Maximal number of memoized calls of every pure API, it'll be assigned by
+# setup
+g_memo_size = DEFAULT_MEMO_SIZE
+
+# APIs returning the same result for the same arguments as long as the
+# database is not modified. These are memoized unless their recorded calls
+# show otherwise, other APIs are memoized only if their recorded calls
+# repeated arguments and always returned the same result for them
+PURE_APIS = frozenset((
+    'get_name', 'get_func', 'get_func_name', 'get_func_qty', 'getn_func',
+    'get_segm_name', 'getseg', 'get_segm_by_name', 'get_segm_qty',
+    'get_byte', 'get_word', 'get_dword', 'get_qword', 'get_bytes',
+    'get_wide_byte', 'get_wide_word', 'get_wide_dword', 'get_flags',
+    'get_full_flags', 'get_item_size', 'get_item_head', 'get_item_end',
+    'print_insn_mnem', 'GetMnem', 'GetFunctionName', 'SegName', 'Name',
+    'GetDisasm', 'generate_disasm_line', 'get_inf_structure',
+    'get_root_filename', 'get_input_file_path', 'get_imagebase',
+))
+
 
 def logger():
     return logging.getLogger('pytest_idapro.internal.replay')
 
 
-def setup(base_paths):
+def setup(base_paths, replay_mode='score', callstack_depth=None,
+          memo_size=None):
     global g_paths_re
+    global g_replay_mode
+    global g_callstack_depth
+    global g_memo_size
     g_paths_re = re.compile('^({})'.format("|".join(base_paths)))
+    g_replay_mode = replay_mode
+    g_callstack_depth = callstack_depth
+    g_memo_size = DEFAULT_MEMO_SIZE if memo_size is None else memo_size
+
+
+def load_records(records_file):
+    """Load a recording file, either dumped as a single json document,
+    streamed as json lines or written with an index of all records"""
+    with open(records_file, 'rb') as fh:
+        header = fh.read(8)
+        fh.seek(0)
+
+        if header == rm.INDEXED_MAGIC:
+            return load_records_indexed(fh)
+        elif header == rm.BINARY_MAGIC:
+            return load_records_binary(fh)
+        elif header[:1] == b'[':
+            return load_records_stream(fh)
+        return json.load(fh)
+
+
+def load_records_binary(fh):
+    """Decompress and decode a binary records file"""
+    compression = bytearray(fh.read(len(rm.BINARY_MAGIC) + 1))[-1]
+    data = fh.read()
+    if compression == rm.BINARY_COMPRESSIONS['gzip']:
+        # gzip, which is zlib with a gzip header
+        data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    elif compression == rm.BINARY_COMPRESSIONS['zstd']:
+        import zstandard
+        data = zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    elif compression != rm.BINARY_COMPRESSIONS['none']:
+        raise ValueError("Unsupported binary records compression",
+                         compression)
+
+    return BinaryRecordsReader(data).read()
+
+
+class BinaryRecordsReader(object):
+    """Decode records written by record_module's BinaryRecordsWriter"""
+
+    def __init__(self, data):
+        self.data = bytearray(data)
+        self.pos = 0
+        self.strings = []
+        self.readers = {
+            rm.BINARY_NONE: lambda tag: None,
+            rm.BINARY_FALSE: lambda tag: False,
+            rm.BINARY_TRUE: lambda tag: True,
+            rm.BINARY_INT: self.read_int,
+            rm.BINARY_FLOAT: self.read_float,
+            rm.BINARY_STR_NEW: self.read_str,
+            rm.BINARY_STR_REF: self.read_str,
+            rm.BINARY_STR_RAW: self.read_str,
+            rm.BINARY_LIST: self.read_list,
+            rm.BINARY_DICT: self.read_dict,
+        }
+
+    def read(self):
+        return self.read_value()
+
+    def read_varint(self):
+        data = self.data
+        b = data[self.pos]
+        self.pos += 1
+        n = b & 0x7f
+        shift = 7
+        while b >= 0x80:
+            b = data[self.pos]
+            self.pos += 1
+            n |= (b & 0x7f) << shift
+            shift += 7
+        return n
+
+    def read_value(self):
+        tag = self.data[self.pos]
+        self.pos += 1
+        try:
+            reader = self.readers[tag]
+        except KeyError:
+            raise ValueError("Invalid binary records tag", tag, self.pos)
+        return reader(tag)
+
+    def read_int(self, tag):
+        n = self.read_varint()
+        return n >> 1 if not n & 1 else -(n >> 1) - 1
+
+    def read_float(self, tag):
+        self.pos += 8
+        return struct.unpack_from('<d', self.data, self.pos - 8)[0]
+
+    def read_str(self, tag):
+        if tag == rm.BINARY_STR_REF:
+            return self.strings[self.read_varint()]
+
+        length = self.read_varint()
+        s = self.data[self.pos:self.pos + length].decode('utf-8')
+        self.pos += length
+        if tag == rm.BINARY_STR_NEW:
+            self.strings.append(s)
+        return s
+
+    def read_list(self, tag):
+        return [self.read_value() for _ in range(self.read_varint())]
+
+    def read_dict(self, tag):
+        d = {}
+        for _ in range(self.read_varint()):
+            k = self.read_value()
+            d[k] = self.read_value()
+        return d
+
+
+def load_records_indexed(fh):
+    """Map an indexed records file to memory, returning lazy records of every
+    module that only deserialize attribute records once they're accessed"""
+    data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    index_offset, = struct.unpack_from('<Q', data, len(rm.INDEXED_MAGIC))
+    index = json.loads(data[index_offset:].decode('utf-8'))
+    return {module_name: LazyRecords(data, module_index)
+            for module_name, module_index in index.items()}
+
+
+def load_records_stream(fh):
+    """Rebuild records from a records stream, where every line is an event
+    setting a key of a records dictionary or appending to a records list"""
+    header = json.loads(fh.readline())
+    if header != rm.STREAM_HEADER:
+        raise ValueError("Unsupported records stream", header)
+
+    records = {}
+    for line in fh:
+        try:
+            event = json.loads(line)
+        except ValueError:
+            # a recording session that was terminated abruptly may leave a
+            # partially written last line
+            logger().warning("Ignoring malformed records stream line: %s",
+                             line)
+            break
+
+        parent = records
+        for key in event[1]:
+            parent = parent[key]
+
+        if event[0] == 's':
+            parent[event[2]] = event[3]
+        elif event[0] == 'a':
+            parent.append(event[2])
+        else:
+            raise ValueError("Unsupported records stream event", event)
+
+    return records
+
+
+class LazyRecords(MutableMapping):
+    """Records of a single module, read from a memory mapped indexed records
+    file and deserialized per attribute on first access"""
+
+    def __init__(self, data, index):
+        self.data = data
+        self.index = index
+        self.records = {}
+
+    def __getitem__(self, key):
+        if key not in self.records:
+            offset, length = self.index[key]
+            record = self.data[offset:offset + length].decode('utf-8')
+            self.records[key] = json.loads(record)
+        return self.records[key]
+
+    def __setitem__(self, key, value):
+        self.records[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.records.pop(key, None)
+        self.index.pop(key, None)
+
+    def __contains__(self, key):
+        return key in self.records or key in self.index
+
+    def __iter__(self):
+        for key in self.index:
+            yield key
+        for key in self.records:
+            if key not in self.index:
+                yield key
+
+    def __len__(self):
+        return len(set(self.index) | set(self.records))
 
 
 def module_replay(module_name, module_record):
@@ -67,15 +308,42 @@ def clean_arg(o):
     return re.sub(' at 0x[0-9a-fA-F]{1,16}>', '>', o)
 
 
+def call_indices(instance_desc):
+    """All call indices of a recorded instance, which are listed as runs of
+    consecutive indices when identical calls were deduplicated"""
+    runs = instance_desc.get('call_indices')
+    if not runs:
+        return [instance_desc['call_index']]
+    return [start + i for start, count in runs for i in range(count)]
+
+
+def nearest_call_index(instance_desc, call_index):
+    """The call index of a recorded instance closest to call_index"""
+    runs = instance_desc.get('call_indices')
+    if not runs:
+        return instance_desc['call_index']
+
+    i = bisect.bisect_right(runs, [call_index, float('inf')]) - 1
+    if i >= 0:
+        start, count = runs[i]
+        if call_index < start + count:
+            return call_index
+        before = start + count - 1
+        if i + 1 == len(runs) or (call_index - before <=
+                                  runs[i + 1][0] - call_index):
+            return before
+    return runs[i + 1][0]
+
+
 def instance_score(instance, name, args, kwargs, callstack, call_index):
     instance_desc = instance['instance_desc']
     s = 0
     s += 100 if str(name) != str(instance_desc['name']) else 0
     s += sum(10 for a, b in zip(args, instance_desc['args']) if a != b)
-    s += sum(10 for a, b in zip(kwargs.items(),
-                                instance_desc['kwargs'].items())
+    s += sum(10 for a, b in zip(sorted_items(kwargs),
+                                sorted_items(instance_desc['kwargs']))
              if a[0] != b[0] or a[1] != b[1])
-    s += 5 * abs(call_index - instance_desc['call_index'])
+    s += 5 * abs(call_index - nearest_call_index(instance_desc, call_index))
 
     for a, b in zip(callstack, instance_desc['callstack']):
         s += abs(a[1] - b['caller_line'])
@@ -85,36 +353,292 @@ def instance_score(instance, name, args, kwargs, callstack, call_index):
     return s, instance
 
 
-def clean_callstack(callstack):
+def clean_callstack(frame):
+    """Collect (file, line, function) tuples of the callstack starting at
+    frame, the same way record_module records callstacks"""
     filtered_callstack = []
-    for cs in callstack:
-        if cs[3].startswith('pytest_'):
+    while frame is not None:
+        if len(filtered_callstack) == g_callstack_depth:
             break
-        if not ('/_pytest/' in cs[1] or '/pytestqt/' in cs[1] or
-                '/pytest_idapro/' in cs[1] or '/python2.7/' in cs[1]):
+
+        filename = frame.f_code.co_filename
+        function = frame.f_code.co_name
+        if function.startswith('pytest_'):
+            break
+        if not ('/_pytest/' in filename or '/pytestqt/' in filename or
+                '/pytest_idapro/' in filename or '/python2.7/' in filename):
             # strip base paths from file names
-            fn = g_paths_re.sub('', cs[1])
-            filtered_callstack.append((fn, cs[2], cs[3]))
+            fn = g_paths_re.sub('', filename)
+            filtered_callstack.append((fn, frame.f_lineno, function))
+        frame = frame.f_back
     return filtered_callstack
 
 
+def sorted_items(d):
+    """Items of a dictionary ordered by key, so that equal dictionaries built
+    in different orders are compared and keyed alike"""
+    return sorted(d.items(), key=lambda item: str(item[0]))
+
+
+def freeze(o):
+    """Convert a cleaned or recorded value to a hashable representation,
+    used to key instances in an InstanceIndex"""
+    if isinstance(o, dict):
+        return tuple((k, freeze(v)) for k, v in sorted_items(o))
+    elif isinstance(o, (list, tuple)):
+        return tuple(freeze(v) for v in o)
+    return o
+
+
+def instance_key(name, args, kwargs, callstack):
+    """Build the key of an InstanceIndex bucket. Any instance outside of a
+    query's bucket and of the same shape is scored at least `BUCKET_SCORE`
+    by instance_score"""
+    return (str(name), freeze(args), freeze(kwargs),
+            tuple((str(cs[0]), str(cs[2])) for cs in callstack))
+
+
+def instance_shape(args, kwargs, callstack):
+    """instance_score only compares the common prefix of arguments and
+    callstacks, so an instance of a different shape may score lower than
+    `BUCKET_SCORE` without sharing the query's bucket"""
+    return len(args), len(kwargs), len(callstack)
+
+
+def prefix_key(name, args, kwargs, callstack, lengths):
+    """Build the instance_key of the first lengths (as an instance_shape) of
+    arguments, keyword arguments and callstack. Instances of another shape
+    are scored at least `BUCKET_SCORE` unless they share the prefix key of
+    the common prefix instance_score compares"""
+    args_len, kwargs_len, callstack_len = lengths
+    return instance_key(name, args[:args_len],
+                        dict(sorted_items(kwargs)[:kwargs_len]),
+                        callstack[:callstack_len])
+
+
+# Lowest score instance_score may give an instance of the same shape that
+# differs from the query in name, arguments or callstack files and functions
+BUCKET_SCORE = 10
+
+
+class InstanceIndex(object):
+    """Precomputed lookup tables over a recorded instances list, matching a
+    replayed call without scoring every recorded instance.
+    Exact matches (including callstack lines and call index) are resolved
+    directly, other instances sharing a bucket with the call are scored and
+    the whole list is scored only when no bucket instance is good enough.
+    Buckets only hold instances of a single shape, instances of other shapes
+    are only scored along with the bucket when they share the prefix of the
+    call that instance_score compares.
+    For sequential replay, the index also keeps a cursor into the instances
+    ordered by their call index. Instances of deduplicated calls appear in
+    the timeline once for every one of their call indices."""
+
+    def __init__(self, instances):
+        self.instances = instances
+        self.buckets = {}
+        self.exact = {}
+        self.shapes = {}
+        self.prefixes = {}
+        timeline = []
+        self.timeline_keys = []
+        self.timeline_positions = {}
+        self.cursor = 0
+
+        for instance in instances:
+            instance_desc = instance['instance_desc']
+            callstack = [(cs['caller_file'], cs['caller_line'],
+                          cs['caller_function'])
+                         for cs in instance_desc['callstack']]
+            key = instance_key(instance_desc['name'], instance_desc['args'],
+                               instance_desc['kwargs'], callstack)
+            lines = tuple(cs[1] for cs in callstack)
+            shape = instance_shape(instance_desc['args'],
+                                   instance_desc['kwargs'], callstack)
+            self.shapes.setdefault(shape, []).append((instance, callstack))
+            self.buckets.setdefault(key, []).append(instance)
+            for call_index in call_indices(instance_desc):
+                self.exact.setdefault((key, lines, call_index),
+                                      []).append(instance)
+                timeline.append((call_index, instance))
+
+        timeline.sort(key=lambda t: t[0])
+        self.timeline = [instance for _, instance in timeline]
+        timeline_keys = {}
+        for position, (call_index, instance) in enumerate(timeline):
+            if id(instance) not in timeline_keys:
+                instance_desc = instance['instance_desc']
+                callstack = [(cs['caller_file'], None, cs['caller_function'])
+                             for cs in instance_desc['callstack']]
+                timeline_keys[id(instance)] = instance_key(
+                    instance_desc['name'], instance_desc['args'],
+                    instance_desc['kwargs'], callstack)
+            self.timeline_keys.append(timeline_keys[id(instance)])
+            self.timeline_positions[id(instance), call_index] = position
+
+    def select(self, name, args, kwargs, callstack, call_index):
+        """Return scored (score, instance) tuples of matching candidates,
+        ordered by score"""
+        def instance_score_wrap(instance):
+            return instance_score(instance, name, args, kwargs, callstack,
+                                  call_index)
+
+        def score_sorted(instances):
+            return sorted(map(instance_score_wrap, instances),
+                          key=lambda x: x[0])
+
+        key = instance_key(name, args, kwargs, callstack)
+        exact_key = (key, tuple(cs[1] for cs in callstack), call_index)
+
+        instances = score_sorted(self.exact.get(exact_key, ()))
+        if instances and instances[0][0] == 0:
+            return instances
+
+        instances = self.buckets.get(key, [])
+        if instances:
+            instances = instances + self.prefix_instances(
+                name, args, kwargs, callstack)
+            instances = score_sorted(instances)
+            if instances[0][0] < BUCKET_SCORE:
+                return instances
+
+        return score_sorted(self.instances)
+
+    def prefix_instances(self, name, args, kwargs, callstack):
+        """Return instances of shapes other than the call's that share the
+        prefix of the call instance_score compares"""
+        shape = instance_shape(args, kwargs, callstack)
+        instances = []
+        for other_shape in self.shapes:
+            if other_shape == shape:
+                continue
+
+            lengths = tuple(min(a, b) for a, b in zip(shape, other_shape))
+            prefixes = self.prefixes.get((other_shape, lengths))
+            if prefixes is None:
+                prefixes = self.prefixes[other_shape, lengths] = {}
+                for instance, instance_callstack in self.shapes[other_shape]:
+                    instance_desc = instance['instance_desc']
+                    prefixes.setdefault(prefix_key(
+                        instance_desc['name'], instance_desc['args'],
+                        instance_desc['kwargs'], instance_callstack,
+                        lengths), []).append(instance)
+            instances.extend(prefixes.get(
+                prefix_key(name, args, kwargs, callstack, lengths), ()))
+        return instances
+
+    def select_next(self, name, args, kwargs, callstack, call_index):
+        """Sequentially match the instance following the previously matched
+        one, falling back to `select` when it is not in the call's bucket"""
+        key = instance_key(name, args, kwargs, callstack)
+        if (self.cursor < len(self.timeline) and
+            self.timeline_keys[self.cursor] == key):
+            instance = self.timeline[self.cursor]
+            self.cursor += 1
+            return [instance_score(instance, name, args, kwargs, callstack,
+                                   call_index)]
+
+        instances = self.select(name, args, kwargs, callstack, call_index)
+        if instances:
+            instance = instances[0][1]
+            nearest = nearest_call_index(instance['instance_desc'], call_index)
+            self.cursor = self.timeline_positions[id(instance), nearest] + 1
+        return instances
+
+    def advance(self, instance, call_index):
+        """Move the cursor past an instance matched without select_next, as
+        select_next would have when the cursor holds a call with the same
+        arguments"""
+        instance_desc = instance['instance_desc']
+        if self.cursor < len(self.timeline):
+            cursor_desc = self.timeline[self.cursor]['instance_desc']
+            if (memo_key(cursor_desc['args'], cursor_desc['kwargs']) ==
+                    memo_key(instance_desc['args'], instance_desc['kwargs'])):
+                self.cursor += 1
+                return
+
+        nearest = nearest_call_index(instance_desc, call_index)
+        self.cursor = self.timeline_positions[id(instance), nearest] + 1
+
+
+def memo_key(args, kwargs):
+    return freeze(args), freeze(sorted(kwargs.items()))
+
+
+class CallMemo(object):
+    """Matches calls of a pure API by their arguments alone, without
+    capturing and scoring callstacks. Only calls with the arguments of a
+    recorded call are matched, and only those of the first size distinct
+    recorded arguments (in recorded order) are kept, other calls are left to
+    instance_select"""
+
+    def __init__(self, recorded):
+        self.recorded = recorded
+
+    @classmethod
+    def build(cls, name, instances, size):
+        """Return a CallMemo of instances if they're the recorded calls of a
+        pure API, otherwise None"""
+        results = {}
+        recorded = {}
+        repeated = False
+        for instance in instances:
+            instance_desc = instance['instance_desc']
+            if instance_desc.get('callback'):
+                return None
+
+            result = freeze(instance_desc.get('retval',
+                                              instance_desc.get('exception')))
+            key = memo_key(instance_desc['args'], instance_desc['kwargs'])
+            if key in results:
+                if result != results[key]:
+                    return None
+                repeated = True
+            else:
+                results[key] = result
+                if len(recorded) < size:
+                    recorded[key] = instance
+                # deduplicated identical calls repeated as well
+                runs = instance_desc.get('call_indices') or ()
+                if sum(count for _, count in runs) > 1:
+                    repeated = True
+
+        if not repeated and name not in PURE_APIS:
+            return None
+        return cls(recorded)
+
+    def get(self, key):
+        return self.recorded.get(key)
+
+
+def next_call_index(records):
+    """Count a replayed call, returning its call index"""
+    if 'replay_call_count' in records:
+        records['replay_call_count'] += 1
+    else:
+        records['replay_call_count'] = 0
+    return records['replay_call_count']
+
+
+def replay_index(records, data_type):
+    if 'replay_index' not in records:
+        records['replay_index'] = InstanceIndex(records[data_type])
+    return records['replay_index']
+
+
 def instance_select(replay_cls, data_type, name, args, kwargs):
-    local_callstack = clean_callstack(inspect.stack()[2:])
+    local_callstack = clean_callstack(sys._getframe(2))
 
-    instances = replay_cls.__records__[data_type]
-    if 'replay_call_count' in replay_cls.__records__:
-        replay_cls.__records__['replay_call_count'] += 1
-    else:
-        replay_cls.__records__['replay_call_count'] = 0
-    call_index = replay_cls.__records__['replay_call_count']
+    records = replay_cls.__records__
+    call_index = next_call_index(records)
     args = [clean_arg(a) for a in args]
     kwargs = {k: clean_arg(v) for k, v in kwargs.items()}
 
-    def instance_score_wrap(instance):
-        return instance_score(instance, name, args, kwargs, local_callstack,
-                              call_index)
-
-    instances = sorted(map(instance_score_wrap, instances), key=lambda x: x[0])
+    if g_replay_mode == 'sequential':
+        select = replay_index(records, data_type).select_next
+    else:
+        select = replay_index(records, data_type).select
+    instances = select(name, args, kwargs, local_callstack, call_index)
 
     if len(instances) == 0:
         raise Exception("Failed matching", replay_cls)
@@ -181,6 +705,9 @@ def replay_factory(name, records):
 
 
 class AbstractReplay(object):
+    # function replays of attributes, created on first access
+    __replays__ = None
+
     def __getattribute__(self, attr):
         object_name = oga(self, '__object_name__')
         records = oga(self, '__records__')
@@ -193,11 +720,23 @@ class AbstractReplay(object):
             return oga(self, attr)
         except AttributeError:
             if attr in records:
-                return replay_factory(attr, records)
+                # function replays are kept, along with their memo
+                replays = oga(self, '__replays__')
+                if replays is not None and attr in replays:
+                    return replays[attr]
+                replay = replay_factory(attr, records)
+                if isinstance(replay, FunctionReplay):
+                    if replays is None:
+                        replays = self.__replays__ = {}
+                    replays[attr] = replay
+                return replay
 
             # If attribute is neither in object nor records, reraise exception
             # from object but log a warning. This, though, could also be an
-            # hasattr call which is expected to not have the attribute
+            # hasattr call which is expected to not have the attribute, as
+            # the import system does for module dunder attributes
+            if attr.startswith('__') and attr.endswith('__'):
+                raise
             logger().warning("Missing attribute '%s' in '%s'", attr,
                              object_name)
             raise
@@ -208,9 +747,34 @@ class ModuleReplay(AbstractReplay):
 
 
 class FunctionReplay(AbstractReplay):
+    # CallMemo of the replayed function, built on its first call
+    __memo__ = None
+    __memo_built__ = False
+
     def __call__(self, *args, **kwargs):
-        instance = instance_select(self, 'call_data', self.__name__, args,
-                                   kwargs)
+        records = self.__records__
+        if not self.__memo_built__:
+            if g_memo_size and 'call_data' in records:
+                self.__memo__ = CallMemo.build(self.__name__,
+                                               records['call_data'],
+                                               g_memo_size)
+            self.__memo_built__ = True
+
+        instance = None
+        memo = self.__memo__
+        if memo is not None:
+            instance = memo.get(memo_key(
+                [clean_arg(a) for a in args],
+                {k: clean_arg(v) for k, v in kwargs.items()}))
+        if instance is not None:
+            # memoized calls are counted like any other call
+            call_index = next_call_index(records)
+            if g_replay_mode == 'sequential':
+                replay_index(records, 'call_data').advance(instance,
+                                                           call_index)
+        else:
+            instance = instance_select(self, 'call_data', self.__name__,
+                                       args, kwargs)
         instance_desc = instance['instance_desc']
 
         if 'callback' in instance_desc and instance_desc['callback']:
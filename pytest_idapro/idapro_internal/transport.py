@@ -0,0 +1,126 @@
+import os
+import sys
+import mmap
+import pickle
+import tempfile
+import time
+
+# limits of a single batch of messages, whichever is reached first
+BATCH_MAX_MESSAGES = 256
+BATCH_MAX_DELAY = 0.1
+
+# messages of at least this many pickled bytes are handed over through a
+# memory mapped file instead of the connection
+PAYLOAD_THRESHOLD = 1 << 20
+
+# prefer a memory backed file system where one is available
+PAYLOAD_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+# the protocol multiprocessing connections pickle with, so that both ends may
+# run different python versions as long as they can exchange messages at all
+PICKLE_PROTOCOL = getattr(pickle, 'DEFAULT_PROTOCOL', 2)
+
+
+class PayloadWriter(object):
+    """File-like target of a pickler, keeping pickled data in memory until it
+    reaches threshold bytes and streaming it to a payload file from then on,
+    so large messages are never held in memory as a whole"""
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.size = 0
+        self.chunks = []
+        self.fh = None
+        self.path = None
+
+    def write(self, data):
+        if self.fh is None:
+            self.size += len(data)
+            if self.size < self.threshold:
+                self.chunks.append(bytes(data))
+                return
+
+            fd, self.path = tempfile.mkstemp(prefix="pytest-idapro-",
+                                             suffix=".payload",
+                                             dir=PAYLOAD_DIR)
+            self.fh = os.fdopen(fd, 'wb')
+            for chunk in self.chunks:
+                self.fh.write(chunk)
+            self.chunks = None
+        self.fh.write(data)
+
+    def close(self):
+        if self.fh is not None:
+            self.fh.close()
+
+    def discard(self):
+        self.close()
+        if self.path is not None:
+            os.remove(self.path)
+
+
+def send_message(conn, message, threshold=PAYLOAD_THRESHOLD):
+    """Send message through conn, handing over large messages through a
+    file and only sending ('payload', path) through conn"""
+    writer = PayloadWriter(threshold)
+    try:
+        pickle.dump(message, writer, PICKLE_PROTOCOL)
+        writer.close()
+    except BaseException:
+        writer.discard()
+        raise
+
+    if writer.path is None:
+        conn.send_bytes(b''.join(writer.chunks))
+    else:
+        conn.send(('payload', writer.path))
+
+
+def read_payload(path):
+    """Load a message handed over by send_message and remove its file"""
+    try:
+        with open(path, 'rb') as fh:
+            payload = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                # python2's pickle only loads from strings
+                if sys.version_info[0] < 3:
+                    return pickle.loads(payload[:])
+                return pickle.loads(payload)
+            finally:
+                payload.close()
+    finally:
+        os.remove(path)
+
+
+class BatchSender(object):
+    """Coalesces messages into ('batch', [message, ...]) messages to reduce
+    per-message IPC overhead. A batch is sent at the first boundary after it
+    reached max_messages messages or became max_delay seconds old, or before
+    any message sent directly so that ordering is kept. Messages are only
+    ever sent from the caller's thread"""
+    def __init__(self, conn, max_messages=BATCH_MAX_MESSAGES,
+                 max_delay=BATCH_MAX_DELAY):
+        self.conn = conn
+        self.max_messages = max_messages
+        self.max_delay = max_delay
+        self.batch = []
+        self.batch_start = None
+
+    def send(self, message):
+        self.flush()
+        send_message(self.conn, message)
+
+    def send_batched(self, message):
+        if not self.batch:
+            self.batch_start = time.time()
+        self.batch.append(message)
+
+    def boundary(self):
+        if (len(self.batch) >= self.max_messages or
+            (self.batch and
+             time.time() - self.batch_start >= self.max_delay)):
+            self.flush()
+
+    def flush(self):
+        if self.batch:
+            send_message(self.conn, ('batch', self.batch))
+            self.batch = []
@@ -1,48 +1,33 @@
-from . import idaapi
+import importlib
 
-from . import idc
-from . import idautils
+modules_list = ['ida_allins', 'ida_area', 'ida_auto', 'ida_bytes', 'ida_dbg',
+                'ida_diskio', 'ida_entry', 'ida_enum', 'ida_expr', 'ida_fixup',
+                'ida_fpro', 'ida_frame', 'ida_funcs', 'ida_gdl', 'ida_graph',
+                'ida_hexrays', 'ida_ida', 'ida_idaapi', 'ida_idd', 'ida_idp',
+                'ida_ints', 'ida_kernwin', 'ida_lines', 'ida_loader',
+                'ida_moves', 'ida_nalt', 'ida_name', 'ida_netnode',
+                'ida_offset', 'ida_pro', 'ida_problems', 'ida_queue',
+                'ida_registry', 'ida_search', 'ida_segment', 'ida_segregs',
+                'ida_srarea', 'ida_strlist', 'ida_struct', 'ida_typeinf',
+                'ida_ua', 'ida_xref', 'ida_range']
+modules_list.extend(['idaapi', 'idc', 'idautils'])
 
-from . import ida_allins
-from . import ida_area
-from . import ida_auto
-from . import ida_bytes
-from . import ida_dbg
-from . import ida_diskio
-from . import ida_entry
-from . import ida_enum
-from . import ida_expr
-from . import ida_fixup
-from . import ida_fpro
-from . import ida_frame
-from . import ida_funcs
-from . import ida_gdl
-from . import ida_graph
-from . import ida_hexrays
-from . import ida_ida
-from . import ida_idaapi
-from . import ida_idd
-from . import ida_idp
-from . import ida_ints
-from . import ida_kernwin
-from . import ida_lines
-from . import ida_loader
-from . import ida_moves
-from . import ida_nalt
-from . import ida_name
-from . import ida_netnode
-from . import ida_offset
-from . import ida_pro
-from . import ida_problems
-from . import ida_queue
-from . import ida_range
-from . import ida_registry
-from . import ida_search
-from . import ida_segment
-from . import ida_segregs
-from . import ida_srarea
-from . import ida_strlist
-from . import ida_struct
-from . import ida_typeinf
-from . import ida_ua
-from . import ida_xref
+# set by the mock plugin to create its Qt application, which Qt based mock
+# classes require before they are used
+app_start = None
+
+
+def get_module(module_name):
+    """Import and return a mock module. Mock modules are only imported when
+    first used, as some are expensive to import (ida_kernwin imports Qt)"""
+    if module_name not in modules_list:
+        raise ImportError("No mock module named {}".format(module_name))
+    return importlib.import_module('.' + module_name, __name__)
+
+
+def __getattr__(name):
+    # lazy attribute access to submodules, python 3.7 and later
+    if name in modules_list:
+        return get_module(name)
+    raise AttributeError("module {} has no attribute "
+                         "{}".format(__name__, name))
@@ -0,0 +1,203 @@
+"""An in-memory model of an IDA database backing the mocked IDA modules.
+
+Functions, segments and names are kept in arrays sorted by address so that
+mocked APIs can look them up using bisect. A database is described by a
+dictionary (or a JSON file holding one) of the following form, where all
+addresses are either integers or hexadecimal strings:
+
+    {"min_ea": "0x401000", "max_ea": "0x403000",
+     "segments": [{"start": "0x401000", "end": "0x402000", "name": ".text",
+                   "bytes": "5589e5..."}],
+     "functions": [{"start": "0x401000", "end": "0x401010",
+                    "name": "main", "chunks": [["0x401100", "0x401110"]]}],
+     "names": {"0x401800": "global_var"}}
+"""
+import binascii
+import bisect
+import contextlib
+import json
+import numbers
+
+
+def to_ea(value):
+    if isinstance(value, numbers.Integral):
+        return value
+    return int(value, 0)
+
+
+class Range(object):
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+
+    def __contains__(self, ea):
+        return self.start <= ea < self.end
+
+
+class Segment(Range):
+    def __init__(self, start, end, name, data):
+        super(Segment, self).__init__(start, end)
+        self.name = name
+        self.data = data
+
+
+class Function(Range):
+    def __init__(self, start, end, name):
+        super(Function, self).__init__(start, end)
+        self.name = name
+        # function chunks, starting with the function's own range
+        self.chunks = [Range(start, end)]
+
+
+class Database(object):
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.min_ea = 0
+        self.max_ea = 0
+        self.segments = []
+        self.segment_starts = []
+        self.functions = []
+        self.function_starts = []
+        # chunks of all functions as (chunk, function) tuples
+        self.chunks = []
+        self.chunk_starts = []
+        self.names = {}
+        self.name_eas = {}
+
+    def is_empty(self):
+        return not (self.segments or self.functions or self.names)
+
+    def load(self, description):
+        """Replace the database with the one described by description, a
+        dictionary or a path to a JSON file holding one"""
+        if not isinstance(description, dict):
+            with open(description, 'r') as fh:
+                description = json.load(fh)
+
+        self.clear()
+        for segment in description.get('segments', ()):
+            start = to_ea(segment['start'])
+            end = to_ea(segment['end'])
+            data = bytearray(binascii.unhexlify(segment.get('bytes', '')))
+            # unknown bytes are zero, as a bss segment would be
+            data.extend(b'\x00' * (end - start - len(data)))
+            self.segments.append(Segment(start, end, segment.get('name', ''),
+                                         data))
+        self.segments.sort(key=lambda s: s.start)
+        self.segment_starts = [s.start for s in self.segments]
+
+        for function in description.get('functions', ()):
+            start = to_ea(function['start'])
+            func = Function(start, to_ea(function['end']),
+                            function.get('name', "sub_{:X}".format(start)))
+            for chunk_start, chunk_end in function.get('chunks', ()):
+                func.chunks.append(Range(to_ea(chunk_start),
+                                         to_ea(chunk_end)))
+            self.functions.append(func)
+            self.chunks.extend((chunk, func) for chunk in func.chunks)
+            self.set_name(func.start, func.name)
+        self.functions.sort(key=lambda f: f.start)
+        self.function_starts = [f.start for f in self.functions]
+        self.chunks.sort(key=lambda c: c[0].start)
+        self.chunk_starts = [c.start for c, _ in self.chunks]
+
+        for ea, name in description.get('names', {}).items():
+            self.set_name(to_ea(ea), name)
+
+        # default to the range covered by segments
+        ranges = self.segments or self.functions
+        self.min_ea = to_ea(description.get('min_ea', min(
+            [r.start for r in ranges] or [0])))
+        self.max_ea = to_ea(description.get('max_ea', max(
+            [r.end for r in ranges] or [0])))
+
+    @contextlib.contextmanager
+    def isolate(self):
+        """Start with an empty database and restore the current one once
+        done"""
+        state = dict(vars(self))
+        self.clear()
+        try:
+            yield self
+        finally:
+            vars(self).clear()
+            vars(self).update(state)
+
+    @staticmethod
+    def find(starts, items, ea, key=lambda item: item):
+        """Return the item of the range containing ea, or None"""
+        i = bisect.bisect_right(starts, ea) - 1
+        if i >= 0 and ea in key(items[i]):
+            return items[i]
+        return None
+
+    # segments
+    def get_segment(self, ea):
+        return self.find(self.segment_starts, self.segments, ea)
+
+    def next_segment(self, ea):
+        i = bisect.bisect_right(self.segment_starts, ea)
+        return self.segments[i] if i < len(self.segments) else None
+
+    def prev_segment(self, ea):
+        i = bisect.bisect_left(self.segment_starts, ea) - 1
+        return self.segments[i] if i >= 0 else None
+
+    # functions
+    def get_function(self, ea):
+        chunk = self.find(self.chunk_starts, self.chunks, ea,
+                          key=lambda c: c[0])
+        return chunk[1] if chunk else None
+
+    def get_chunk(self, ea):
+        return self.find(self.chunk_starts, self.chunks, ea,
+                         key=lambda c: c[0])
+
+    def next_chunk(self, ea):
+        i = bisect.bisect_right(self.chunk_starts, ea)
+        return self.chunks[i] if i < len(self.chunks) else None
+
+    def next_function(self, ea):
+        i = bisect.bisect_right(self.function_starts, ea)
+        return self.functions[i] if i < len(self.functions) else None
+
+    def prev_function(self, ea):
+        i = bisect.bisect_left(self.function_starts, ea) - 1
+        return self.functions[i] if i >= 0 else None
+
+    # names
+    def get_name(self, ea):
+        return self.names.get(ea, "")
+
+    def get_name_ea(self, name):
+        return self.name_eas.get(name)
+
+    def set_name(self, ea, name):
+        old_name = self.names.pop(ea, None)
+        if old_name is not None:
+            self.name_eas.pop(old_name, None)
+        if name:
+            self.names[ea] = name
+            self.name_eas[name] = ea
+        return True
+
+    # bytes
+    def get_bytes(self, ea, size):
+        segment = self.get_segment(ea)
+        if segment is None or ea + size > segment.end:
+            return None
+        offset = ea - segment.start
+        return bytes(segment.data[offset:offset + size])
+
+    def patch_bytes(self, ea, buf):
+        segment = self.get_segment(ea)
+        if segment is None or ea + len(buf) > segment.end:
+            return False
+        offset = ea - segment.start
+        segment.data[offset:offset + len(buf)] = buf
+        return True
+
+
+database = Database()
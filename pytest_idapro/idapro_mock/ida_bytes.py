@@ -0,0 +1,43 @@
+import struct
+
+from .database import database
+
+
+def get_bytes(ea, size, gmb_flags=0):
+    return database.get_bytes(ea, size)
+
+
+def _get_value(ea, fmt):
+    buf = database.get_bytes(ea, struct.calcsize(fmt))
+    if buf is None:
+        # IDA returns all bits set for unloaded bytes
+        return (1 << (8 * struct.calcsize(fmt))) - 1
+    return struct.unpack(fmt, buf)[0]
+
+
+def get_byte(ea):
+    return _get_value(ea, '<B')
+
+
+def get_word(ea):
+    return _get_value(ea, '<H')
+
+
+def get_dword(ea):
+    return _get_value(ea, '<I')
+
+
+def get_qword(ea):
+    return _get_value(ea, '<Q')
+
+
+def is_loaded(ea):
+    return database.get_segment(ea) is not None
+
+
+def patch_bytes(ea, buf):
+    return database.patch_bytes(ea, bytearray(buf))
+
+
+def patch_byte(ea, value):
+    return database.patch_bytes(ea, bytearray([value]))
@@ -0,0 +1,113 @@
+import bisect
+
+from .database import database
+from .mock import MockObject
+
+
+FUNC_TAIL = 0x00008000
+
+
+class func_t(MockObject):
+    def __init__(self, start_ea, end_ea, flags=0):
+        super(func_t, self).__init__(start_ea, end_ea, flags)
+        self.start_ea = self.startEA = start_ea
+        self.end_ea = self.endEA = end_ea
+        self.flags = flags
+
+    def __eq__(self, other):
+        return (isinstance(other, func_t) and
+                (self.start_ea, self.end_ea) == (other.start_ea,
+                                                 other.end_ea))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.start_ea, self.end_ea))
+
+
+def _func(function):
+    if function is None:
+        return None
+    return func_t(function.start, function.end)
+
+
+def _chunk(chunk):
+    if chunk is None:
+        return None
+    chunk, function = chunk
+    flags = 0 if chunk.start == function.start else FUNC_TAIL
+    return func_t(chunk.start, chunk.end, flags)
+
+
+def get_func(ea):
+    return _func(database.get_function(ea))
+
+
+def get_fchunk(ea):
+    return _chunk(database.get_chunk(ea))
+
+
+def get_next_fchunk(ea):
+    return _chunk(database.next_chunk(ea))
+
+
+def get_next_func(ea):
+    return _func(database.next_function(ea))
+
+
+def get_prev_func(ea):
+    return _func(database.prev_function(ea))
+
+
+def get_func_qty():
+    return len(database.functions)
+
+
+def getn_func(n):
+    if not 0 <= n < len(database.functions):
+        return None
+    return _func(database.functions[n])
+
+
+def get_func_num(ea):
+    function = database.get_function(ea)
+    if function is None:
+        return -1
+    return bisect.bisect_left(database.function_starts, function.start)
+
+
+def get_func_name(ea):
+    function = database.get_function(ea)
+    if function is None:
+        return None
+    return database.get_name(function.start)
+
+
+class func_tail_iterator_t(MockObject):
+    """Iterate over all chunks of a function, starting with its head"""
+    def __init__(self, pfn=None, ea=None):
+        super(func_tail_iterator_t, self).__init__(pfn, ea)
+        function = None
+        if pfn is not None:
+            function = database.get_function(pfn.start_ea)
+        self.chunks = function.chunks if function else []
+        self.index = 0
+
+    def main(self):
+        self.index = 0
+        return bool(self.chunks)
+
+    def first(self):
+        # only tail chunks
+        self.index = 1
+        return len(self.chunks) > 1
+
+    def next(self):
+        self.index += 1
+        return self.index < len(self.chunks)
+
+    def chunk(self):
+        chunk = self.chunks[self.index]
+        flags = FUNC_TAIL if self.index else 0
+        return func_t(chunk.start, chunk.end, flags)
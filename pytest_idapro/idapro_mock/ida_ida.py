@@ -0,0 +1,30 @@
+from .database import database
+
+
+class _inf(object):
+    @property
+    def min_ea(self):
+        return database.min_ea
+
+    @property
+    def max_ea(self):
+        return database.max_ea
+
+    # names used prior to IDA7
+    minEA = min_ea
+    maxEA = max_ea
+
+
+class _cvar(object):
+    inf = _inf()
+
+
+cvar = _cvar()
+
+
+def inf_get_min_ea():
+    return database.min_ea
+
+
+def inf_get_max_ea():
+    return database.max_ea
@@ -1,7 +1,6 @@
-from .mock import MockObject
+import sys
 
-# TODO: support other pyqt libraries
-from PyQt5 import QtWidgets
+from .mock import MockObject
 
 # Passed as 'flags' parameter to attach_action_to_menu()
 SETMENU_INS = 0  # add menu item before the specified path (default)
@@ -74,21 +73,49 @@ def execute_sync(callback, reqf):
 FORM_VALUE = "##FORM_ID##"
 
 
-class PluginForm(QtWidgets.QDialog, MockObject):
-    def OnCreate(self, form):
-        pass
+def plugin_form_class():
+    """Create PluginForm on first use, as it requires importing Qt and a Qt
+    application"""
+    global PluginForm
+
+    # TODO: support other pyqt libraries
+    from PyQt5 import QtWidgets
+
+    from . import app_start
+    if app_start:
+        app_start()
+
+    class PluginForm(QtWidgets.QDialog, MockObject):
+        def OnCreate(self, form):
+            pass
+
+        def Show(self, title=""):
+            self.OnCreate(FORM_VALUE)
+            QtWidgets.QDialog.show(self)
+
+        def FormToPyQtWidget(self, form):
+            assert form == FORM_VALUE
+
+            # Normally, PluginForm is not a QtDialog object and retrieveing
+            # the widget requires calling IDA API, however while mocking
+            # PluginForm, we made it a sinlge object, so that API returns it's
+            # self object
+            return self
+
+    return PluginForm
+
 
-    def Show(self, title=""):
-        self.OnCreate(FORM_VALUE)
-        QtWidgets.QDialog.show(self)
+def __getattr__(name):
+    # lazy creation of Qt based classes, python 3.7 and later
+    if name == 'PluginForm':
+        return plugin_form_class()
+    raise AttributeError("module {} has no attribute "
+                         "{}".format(__name__, name))
 
-    def FormToPyQtWidget(self, form):
-        assert form == FORM_VALUE
 
-        # Normally, PluginForm is not a QtDialog object and retrieveing the
-        # widget requires calling IDA API, however while mocking PluginForm, we
-        # made it a sinlge object, so that API returns it's self object
-        return self
+# older versions have no module level __getattr__
+if sys.version_info < (3, 7):
+    plugin_form_class()
 
 
 # Just let this be called and do nothing, there's no need to execute or return
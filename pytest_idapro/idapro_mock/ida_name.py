@@ -1,3 +1,22 @@
+from .database import database
+from .ida_idaapi import BADADDR
+
+
 # in IDA7, _from variable should be dropped
-def get_name(_from, ea):
-    return "dummy_function_name_{:x}".format(ea)
+def get_name(_from, ea=None):
+    if ea is None:
+        ea = _from
+
+    if database.is_empty():
+        # without a database every address is named
+        return "dummy_function_name_{:x}".format(ea)
+    return database.get_name(ea)
+
+
+def get_name_ea(_from, name):
+    ea = database.get_name_ea(name)
+    return BADADDR if ea is None else ea
+
+
+def set_name(ea, name, flags=0):
+    return database.set_name(ea, name)
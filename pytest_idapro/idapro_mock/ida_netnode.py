@@ -1,4 +1,8 @@
+import base64
+import contextlib
+import copy
 import json
+import numbers
 import os
 import random
 
@@ -10,49 +14,264 @@ vtag = 'V'
 ntag = 'N'
 ltag = 'L'
 
+# netnode value, kept as a supval of this index under vtag
+VALUE_IDX = -1
+
+
+def encode_value(value):
+    if isinstance(value, bytes):
+        return {'b64': base64.b64encode(value).decode('ascii')}
+    return value
+
+
+def decode_value(value):
+    if isinstance(value, dict) and 'b64' in value:
+        return base64.b64decode(value['b64'])
+    return value
+
+
+def encode_idx(idx):
+    # json keys are always strings, keep track of integer indices
+    if isinstance(idx, numbers.Integral):
+        return 'i:{}'.format(idx)
+    return 's:' + idx
+
+
+def decode_idx(key):
+    if key.startswith('s:'):
+        return key[2:]
+    return int(key[2:])
+
+
+class NetnodeStore(object):
+    """A process wide store of netnode data, shared by all netnode objects of
+    the same name. Netnodes are loaded from JSON files in path the first time
+    they're used and kept in memory, and all modified netnodes are written
+    back once flush is called (at the end of the test session)"""
+    def __init__(self, path):
+        self.path = path
+        self.nodes = {}
+        self.dirty = set()
+        self.killed = set()
+        self.isolated = False
+
+    def node_path(self, name):
+        return os.path.join(self.path, name + "_netnode.json")
+
+    def get(self, name, do_create=False):
+        """Return the tags dictionary of netnode name, or None if it does not
+        exist and do_create is False"""
+        if (name not in self.nodes and name not in self.killed and
+            not self.isolated):
+            self.load(name)
+
+        if name not in self.nodes:
+            if not do_create:
+                return None
+            self.nodes[name] = {}
+            self.dirty.add(name)
+            self.killed.discard(name)
+        return self.nodes[name]
+
+    def load(self, name):
+        node_path = self.node_path(name)
+        if not os.path.isfile(node_path):
+            return
+
+        with open(node_path, 'r') as fh:
+            data = json.load(fh)
+
+        if data.get('version') == 1:
+            self.nodes[name] = {tag: {decode_idx(k): decode_value(v)
+                                      for k, v in values.items()}
+                                for tag, values in data['tags'].items()}
+        else:
+            # older files only held hash values
+            self.nodes[name] = {htag: data}
+
+    def modified(self, name):
+        self.dirty.add(name)
+
+    def kill(self, name):
+        # netnode objects of the same name share the tags dictionary, empty
+        # it for the objects still referencing the killed netnode
+        tags = self.nodes.pop(name, None)
+        if tags is not None:
+            tags.clear()
+        self.killed.add(name)
+        self.dirty.add(name)
+
+    def preset(self, nodes):
+        """Replace the data of netnodes, provided as a dictionary mapping
+        netnode names to dictionaries of tags, mapping indices to values"""
+        for name, tags in nodes.items():
+            self.kill(name)
+            self.get(name, do_create=True).update(copy.deepcopy(tags))
+
+    def flush(self):
+        if self.isolated or not self.dirty:
+            return
+
+        if not os.path.exists(self.path):
+            os.mkdir(self.path)
+
+        for name in self.dirty:
+            if name in self.killed:
+                if os.path.isfile(self.node_path(name)):
+                    os.remove(self.node_path(name))
+                continue
+            if name not in self.nodes:
+                continue
+            tags = {tag: {encode_idx(k): encode_value(v)
+                          for k, v in values.items()}
+                    for tag, values in self.nodes[name].items()}
+            with open(self.node_path(name), 'w') as fh:
+                json.dump({'version': 1, 'tags': tags}, fh)
+        self.dirty = set()
+        self.killed = set()
+
+    @contextlib.contextmanager
+    def isolate(self):
+        """Start with no netnodes and discard all changes once done, without
+        reading or writing any netnode files meanwhile"""
+        state = (self.nodes, self.dirty, self.killed, self.isolated)
+        self.nodes, self.dirty, self.killed, self.isolated = ({}, set(),
+                                                              set(), True)
+        try:
+            yield self
+        finally:
+            self.nodes, self.dirty, self.killed, self.isolated = state
+
+
+netnode_store = NetnodeStore("netnodes/")
 
-class netnode(object):
-    """Fake an IDB netnode object using JSON files for actual storage of data
-    This means we won't store data differently for "different" idb files.
-    Currently there's no way to control in tests whether a there are preset
-    netnodes or data should start from scratch for each test. We'll need to
-    provide markers for that in the future."""
 
-    NETNODE_PATH = "netnodes/"
+class netnode(object):
+    """Fake an IDB netnode object. Data is kept in the process wide
+    netnode_store, and is therefore shared between netnode objects of the
+    same name, and persisted in JSON files between sessions. This means we
+    won't store data differently for "different" idb files. The
+    idapro_netnodes fixture provides control over netnode data per test"""
 
-    def __init__(self, name, namlen=0, do_create=False):
-        # TODO: provide control over the initial state of netnode data to the
-        # test user
+    def __init__(self, name=None, namlen=0, do_create=False):
         if name and namlen and len(name) != namlen:
             raise ValueError("Name Length provided but is wrong!")
 
         if not name:
             name = "unnamed_{}".format(random.randrange(2**32 - 1))
-        self.name = self.NETNODE_PATH + name + "_netnode.json"
+        self._name = name
 
-        if os.path.isfile(name):
-            with open(name, 'r') as fh:
-                self.data = json.load(fh)
-        elif do_create:
-            self.data = {}
-        else:
+        self.data = netnode_store.get(name, do_create)
+        if self.data is None:
             # TBD: do we need to raise an exception here? maybe allow this
             # somehow?
             raise Exception("Did not create a non-existant netnode")
 
-    def __del__(self):
-        if not os.path.exists(self.NETNODE_PATH):
-            os.mkdir(self.NETNODE_PATH)
+    def get_name(self):
+        return self._name
+
+    def kill(self):
+        netnode_store.kill(self._name)
+
+    def _tags(self, do_create=False):
+        # the netnode may have been killed since, in which case it has no data
+        # until written again
+        data = netnode_store.get(self._name, do_create)
+        if data is not None:
+            self.data = data
+        return data
+
+    def _get(self, idx, tag, default=None):
+        return (self._tags() or {}).get(tag, {}).get(idx, default)
+
+    def _set(self, idx, value, tag):
+        self._tags(do_create=True).setdefault(tag, {})[idx] = value
+        netnode_store.modified(self._name)
+        return True
+
+    def _del(self, idx, tag):
+        values = (self._tags() or {}).get(tag, {})
+        if idx not in values:
+            return False
+        del values[idx]
+        netnode_store.modified(self._name)
+        return True
+
+    # netnode value
+    def valobj(self):
+        return self._get(VALUE_IDX, vtag)
+
+    def valstr(self):
+        value = self.valobj()
+        return None if value is None else to_str(value)
+
+    def set(self, value):
+        return self._set(VALUE_IDX, value, vtag)
+
+    def delvalue(self):
+        return self._del(VALUE_IDX, vtag)
+
+    # array of values indexed by integers
+    def supval(self, idx, tag=stag):
+        return self._get(idx, tag)
+
+    def supstr(self, idx, tag=stag):
+        value = self.supval(idx, tag)
+        return None if value is None else to_str(value)
+
+    def supset(self, idx, value, tag=stag):
+        return self._set(idx, value, tag)
 
-        with open(self.name, 'w') as fh:
-            json.dump(self.data, fh)
+    def supdel(self, idx, tag=stag):
+        return self._del(idx, tag)
+
+    def altval(self, idx, tag=atag):
+        return self._get(idx, tag, 0)
+
+    def altset(self, idx, value, tag=atag):
+        return self._set(idx, value, tag)
+
+    def altdel(self, idx, tag=atag):
+        return self._del(idx, tag)
+
+    def charval(self, idx, tag):
+        return self._get(idx, tag, 0)
+
+    def charset(self, idx, value, tag):
+        return self._set(idx, value, tag)
+
+    def chardel(self, idx, tag):
+        return self._del(idx, tag)
+
+    # array of values indexed by strings
+    def hashval(self, idx, tag=htag):
+        return self._get(idx, tag)
 
     def hashstr(self, idx, tag=htag):
-        # TODO: support different tags
-        if tag != htag:
-            raise NotImplementedError("Only supporting default tag values")
+        value = self.hashval(idx, tag)
+        return None if value is None else to_str(value)
+
+    def hashval_long(self, idx, tag=htag):
+        return self._get(idx, tag, 0)
+
+    def hashset(self, idx, value, tag=htag):
+        return self._set(idx, value, tag)
+
+    def hashdel(self, idx, tag=htag):
+        return self._del(idx, tag)
+
+    # blobs are kept as a single value at their start index
+    def getblob(self, start, tag):
+        return self._get(start, tag)
+
+    def setblob(self, buf, start, tag):
+        return self._set(start, buf, tag)
+
+    def delblob(self, start, tag):
+        return 1 if self._del(start, tag) else 0
 
-        if idx not in self.data:
-            return None
 
-        return self.data[idx]
+def to_str(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return str(value)
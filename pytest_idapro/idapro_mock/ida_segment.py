@@ -0,0 +1,70 @@
+from .database import database
+from .mock import MockObject
+
+
+class segment_t(MockObject):
+    def __init__(self, start_ea, end_ea, name=""):
+        super(segment_t, self).__init__(start_ea, end_ea, name)
+        self.start_ea = self.startEA = start_ea
+        self.end_ea = self.endEA = end_ea
+        self.name = name
+
+    def __eq__(self, other):
+        return (isinstance(other, segment_t) and
+                (self.start_ea, self.end_ea) == (other.start_ea,
+                                                 other.end_ea))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.start_ea, self.end_ea))
+
+
+def _seg(segment):
+    if segment is None:
+        return None
+    return segment_t(segment.start, segment.end, segment.name)
+
+
+def getseg(ea):
+    return _seg(database.get_segment(ea))
+
+
+def get_segm_qty():
+    return len(database.segments)
+
+
+def getnseg(n):
+    if not 0 <= n < len(database.segments):
+        return None
+    return _seg(database.segments[n])
+
+
+def get_first_seg():
+    return getnseg(0)
+
+
+def get_last_seg():
+    return getnseg(len(database.segments) - 1)
+
+
+def get_next_seg(ea):
+    return _seg(database.next_segment(ea))
+
+
+def get_prev_seg(ea):
+    return _seg(database.prev_segment(ea))
+
+
+def get_segm_by_name(name):
+    for segment in database.segments:
+        if segment.name == name:
+            return _seg(segment)
+    return None
+
+
+def get_segm_name(s, flags=0):
+    if s is None:
+        return None
+    return s.name
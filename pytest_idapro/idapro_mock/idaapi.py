@@ -40,3 +40,12 @@ from .ida_struct import *
 from .ida_typeinf import *
 from .ida_ua import *
 from .ida_xref import *
+
+
+def __getattr__(name):
+    # classes ida_kernwin creates lazily are not star imported
+    if name == 'PluginForm':
+        from . import ida_kernwin
+        return ida_kernwin.PluginForm
+    raise AttributeError("module {} has no attribute "
+                         "{}".format(__name__, name))
@@ -14,6 +14,8 @@ idautils.py - High level utility functions for IDA
 """
 from . import ida_funcs
 from . import ida_ida
+from . import ida_segment
+from .database import database
 
 
 def Functions(start=None, end=None):
@@ -62,3 +64,25 @@ def Chunks(start):
         chunk = func_iter.chunk()
         yield (chunk.startEA, chunk.endEA)
         status = func_iter.next()
+
+
+def Segments():
+    """
+    Get list of segments (sections) in the binary image
+
+    @return: List of segment start addresses.
+    """
+    for n in range(ida_segment.get_segm_qty()):
+        seg = ida_segment.getnseg(n)
+        if seg:
+            yield seg.start_ea
+
+
+def Names():
+    """
+    Returns a list of names
+
+    @return: List of tuples (ea, name)
+    """
+    for ea in sorted(database.names):
+        yield (ea, database.names[ea])
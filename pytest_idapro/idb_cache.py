@@ -0,0 +1,92 @@
+import os
+import glob
+import hashlib
+
+import logging
+
+log = logging.getLogger('pytest-idapro.idb-cache')
+
+DATABASE_EXTENSIONS = ('.idb', '.i64')
+
+# Default maximal size of the cache, in megabytes
+DEFAULT_MAX_SIZE = 10240
+
+
+def is_database(path):
+    return os.path.splitext(path)[1].lower() in DATABASE_EXTENSIONS
+
+
+class IdbCache(object):
+    """An on-disk cache of analyzed databases, keyed by the hash of the input
+    file and the identity of the analyzing IDA executable. Least recently
+    used databases are evicted once the cache exceeds max_size bytes"""
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    @staticmethod
+    def key(ida_path, input_file):
+        h = hashlib.sha256()
+
+        # analysis results depend on the IDA version, identified by the
+        # executable used
+        ida_path = os.path.realpath(ida_path)
+        ida_stat = os.stat(ida_path)
+        h.update("{}:{}:{}\n".format(ida_path, ida_stat.st_size,
+                                     int(ida_stat.st_mtime)).encode('utf-8'))
+
+        with open(input_file, 'rb') as fh:
+            for chunk in iter(lambda: fh.read(1 << 20), b''):
+                h.update(chunk)
+
+        return h.hexdigest()
+
+    def entries(self):
+        return [path for path in glob.glob(os.path.join(self.cache_dir, '*'))
+                if is_database(path) and '.partial-' not in path]
+
+    def lookup(self, key):
+        for ext in DATABASE_EXTENSIONS:
+            path = os.path.join(self.cache_dir, key + ext)
+            if os.path.isfile(path):
+                # mark the entry as recently used
+                os.utime(path, None)
+                log.info("Using cached database %s", path)
+                return path
+        return None
+
+    def partial_path(self, key):
+        """Path for IDA to save a database to, before it is added to the
+        cache. IDA will append the database extension"""
+        return os.path.join(self.cache_dir,
+                            "{}.partial-{}".format(key, os.getpid()))
+
+    def add(self, key, saved_path):
+        ext = os.path.splitext(saved_path)[1]
+        path = os.path.join(self.cache_dir, key + ext)
+        os.rename(saved_path, path)
+        log.info("Cached analyzed database %s", path)
+
+        self.evict(keep=path)
+        return path
+
+    def evict(self, keep=None):
+        entries = []
+        for path in self.entries():
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total_size <= self.max_size:
+                break
+            if path == keep:
+                continue
+
+            log.info("Evicting cached database %s", path)
+            os.remove(path)
+            total_size -= size
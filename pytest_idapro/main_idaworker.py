@@ -1,6 +1,8 @@
 import idaapi
 import idc
 
+import os
+
 try:
     from idapro_internal import idaworker
 except ImportError:
@@ -9,8 +11,12 @@ except ImportError:
 
 def main():
     # TODO: use idc.ARGV with some option parsing package
-    worker = idaworker.IdaWorker(idc.ARGV[1])
-    should_quit = worker.run()
+    daemon = len(idc.ARGV) > 2 and idc.ARGV[2] == 'daemon'
+    authkey = os.environ.get('PYTEST_IDAPRO_AUTHKEY')
+    if authkey is not None:
+        authkey = authkey.encode('ascii')
+    worker = idaworker.IdaWorker(idc.ARGV[1], daemon=daemon, authkey=authkey)
+    should_quit = worker.serve() if daemon else worker.run()
     if should_quit:
         idaapi.qexit(0)
 
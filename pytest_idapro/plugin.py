@@ -18,13 +18,114 @@ def pytest_addoption(parser):
                                           "be used with the --ida-replay flag "
                                           "to simulate test execution without "
                                           "an IDA instance.")
+    group._addoption('--ida-record-format',
+                     choices=('json', 'jsonl', 'indexed', 'binary'),
+                     default='json',
+                     help="Select the format of the --ida-record file. "
+                          "'json' dumps all records at the end of the "
+                          "session, 'jsonl' streams records to the file as "
+                          "json lines while recording, keeping IDA's memory "
+                          "usage flat. 'indexed' dumps records with an index "
+                          "so that replaying only loads records that are "
+                          "actually used. 'binary' dumps records in a "
+                          "compact binary encoding, smaller on disk but "
+                          "slower to load than json. All formats are "
+                          "accepted by --ida-replay.")
+    group._addoption('--ida-record-compression',
+                     choices=('none', 'gzip', 'zstd'), default='none',
+                     help="Compress binary records. zstd requires the "
+                          "zstandard package, otherwise gzip is used. Only "
+                          "acceptable with --ida-record-format=binary.")
+    group._addoption('--ida-record-caller-text', action="store_true",
+                     default=False,
+                     help="Record the source line of every callstack frame "
+                          "when recording. Only acceptable with "
+                          "--ida-record.")
+    group._addoption('--ida-record-include', action="append", default=[],
+                     help="Only record IDA APIs matching a glob pattern over "
+                          "module.name, such as 'ida_funcs.*' or "
+                          "'idc.get_*'. A pattern without a dot matches a "
+                          "whole module. May be given more than once. Only "
+                          "acceptable with --ida-record.")
+    group._addoption('--ida-record-exclude', action="append", default=[],
+                     help="Do not record IDA APIs matching a glob pattern "
+                          "over module.name. Excluded APIs are not wrapped "
+                          "at all. May be given more than once. Only "
+                          "acceptable with --ida-record.")
+    group._addoption('--ida-callstack-depth', type=int, default=None,
+                     help="Maximal number of callstack frames recorded for "
+                          "every call while recording, and used to match "
+                          "calls while replaying. Unlimited by default.")
+    group._addoption('--ida-profile',
+                     help="Profile IDA API calls made by tests, writing the "
+                          "number of calls, cumulative and self time and "
+                          "number of distinct arguments of every API to the "
+                          "specified json file, and self time by callstack "
+                          "in flamegraph collapsed format to the same path "
+                          "with a .collapsed suffix. The hottest APIs are "
+                          "also reported at the end of the session. Only "
+                          "acceptable with --ida.")
+    group._addoption('--ida-profile-sort',
+                     choices=('self', 'cumulative', 'calls',
+                              'distinct_args'),
+                     default='self',
+                     help="Select the column APIs are sorted by when "
+                          "reporting --ida-profile results.")
     group._addoption('--ida-replay', help="Provide a recording of a previous "
                                           "IDA test execution. It will be "
                                           "replayed without an IDA executable "
                                           "as response to IDA API calls.")
+    group._addoption('--ida-replay-mode', choices=('score', 'sequential'),
+                     default='score',
+                     help="Select how replayed calls are matched against the "
+                          "recording. 'score' matches every call by scoring "
+                          "all similar recorded calls, 'sequential' expects "
+                          "calls to repeat in recorded order and only scores "
+                          "calls that deviate from it. Only acceptable with "
+                          "--ida-replay.")
+    group._addoption('--ida-replay-memo-size', type=int, default=None,
+                     help="Maximal number of distinct recorded calls "
+                          "memoized for every pure IDA API when replaying. "
+                          "Calls of APIs that always returned the same "
+                          "result for the same arguments while recording are "
+                          "matched by their arguments alone. 4096 by "
+                          "default, 0 disables memoization. Only acceptable "
+                          "with --ida-replay.")
     group._addoption('--ida-keep', action="store_true", default=False,
                      help="Keep IDA instance running instead of terminating "
                           "it. Only acceptable with --ida.")
+    group._addoption('--ida-daemon', action="store_true", default=False,
+                     help="Run tests in a persistent IDA instance. The first "
+                          "session starts IDA for the given --ida and "
+                          "--ida-file, and later sessions attach to the "
+                          "already running instance instead of starting and "
+                          "loading a new one. Only acceptable with --ida.")
+    group._addoption('--ida-daemon-stop', action="store_true",
+                     default=False,
+                     help="Stop the IDA daemon running for the given --ida "
+                          "and --ida-file, without running any tests. Only "
+                          "acceptable with --ida.")
+    group._addoption('--ida-cache-dir',
+                     help="Directory to cache analyzed databases in. When "
+                          "--ida-file is not a database, it is only analyzed "
+                          "once by every IDA executable and later sessions "
+                          "load the cached database instead. Only acceptable "
+                          "with --ida.")
+    group._addoption('--ida-cache-size', type=int, default=None,
+                     help="Maximal size in megabytes of the analyzed "
+                          "databases cache, least recently used databases "
+                          "are removed when exceeded. 10240 by default. Only "
+                          "acceptable with --ida-cache-dir.")
+    group._addoption('--ida-qt-offscreen', action="store_true",
+                     default=False,
+                     help="Create the Qt application using the offscreen "
+                          "platform, so no X server or xvfb is needed. Not "
+                          "acceptable with --ida.")
+    group._addoption('--ida-workers', type=int, default=1,
+                     help="Number of IDA instances to run tests in. Every "
+                          "instance loads its own copy of --ida-file and "
+                          "tests are distributed between them. Only "
+                          "acceptable with --ida.")
 
 
 @pytest.hookimpl(tryfirst=True)
@@ -32,8 +133,24 @@ def pytest_cmdline_main(config):
     ida_path = config.getoption('--ida')
     ida_file = config.getoption('--ida-file')
     ida_record = config.getoption('--ida-record')
+    ida_record_format = config.getoption('--ida-record-format')
+    ida_record_compression = config.getoption('--ida-record-compression')
+    ida_record_caller_text = config.getoption('--ida-record-caller-text')
+    ida_record_include = config.getoption('--ida-record-include')
+    ida_record_exclude = config.getoption('--ida-record-exclude')
+    ida_callstack_depth = config.getoption('--ida-callstack-depth')
+    ida_profile = config.getoption('--ida-profile')
+    ida_profile_sort = config.getoption('--ida-profile-sort')
     ida_replay = config.getoption('--ida-replay')
+    ida_replay_mode = config.getoption('--ida-replay-mode')
+    ida_replay_memo_size = config.getoption('--ida-replay-memo-size')
     ida_keep = config.getoption('--ida-keep')
+    ida_daemon = config.getoption('--ida-daemon')
+    ida_daemon_stop = config.getoption('--ida-daemon-stop')
+    ida_workers = config.getoption('--ida-workers')
+    ida_cache_dir = config.getoption('--ida-cache-dir')
+    ida_cache_size = config.getoption('--ida-cache-size')
+    ida_qt_offscreen = config.getoption('--ida-qt-offscreen')
 
     # force removal of plugins interfering / incompatible with running
     # internally
@@ -55,6 +172,29 @@ def pytest_cmdline_main(config):
     if ida_record and not ida_path:
         raise pytest.UsageError("Cannot record without running in an IDA "
                                 "instance")
+    if ida_record_format != 'json' and not ida_record:
+        raise pytest.UsageError("--ida-record-format is only meaningful when "
+                                "--ida-record is also provided.")
+    if ida_record_compression != 'none' and ida_record_format != 'binary':
+        raise pytest.UsageError("--ida-record-compression is only meaningful "
+                                "with --ida-record-format=binary.")
+    if ida_record_caller_text and not ida_record:
+        raise pytest.UsageError("--ida-record-caller-text is only meaningful "
+                                "when --ida-record is also provided.")
+    if (ida_record_include or ida_record_exclude) and not ida_record:
+        raise pytest.UsageError("--ida-record-include and "
+                                "--ida-record-exclude are only meaningful "
+                                "when --ida-record is also provided.")
+    if ida_callstack_depth is not None and ida_callstack_depth < 0:
+        raise pytest.UsageError("--ida-callstack-depth must not be negative.")
+
+    # profile related validation
+    if ida_profile and not ida_path:
+        raise pytest.UsageError("Cannot profile without running in an IDA "
+                                "instance")
+    if ida_profile_sort != 'self' and not ida_profile:
+        raise pytest.UsageError("--ida-profile-sort is only meaningful when "
+                                "--ida-profile is also provided.")
 
     # replay related validations
     if ida_replay and ida_path:
@@ -63,15 +203,96 @@ def pytest_cmdline_main(config):
     if ida_replay and not os.path.isfile(ida_replay):
         raise pytest.UsageError("--ida-replay must point to an IDA session "
                                 "recording file.")
+    if ida_replay_mode != 'score' and not ida_replay:
+        raise pytest.UsageError("--ida-replay-mode is only meaningful when "
+                                "--ida-replay is also provided.")
+    if ida_replay_memo_size is not None and ida_replay_memo_size < 0:
+        raise pytest.UsageError("--ida-replay-memo-size must not be "
+                                "negative.")
+    if ida_replay_memo_size is not None and not ida_replay:
+        raise pytest.UsageError("--ida-replay-memo-size is only meaningful "
+                                "when --ida-replay is also provided.")
 
     if ida_keep and not ida_path:
         raise pytest.UsageError("--ida-keep is only meaningful when --ida is "
                                 "also provided.")
+    if ida_daemon and not ida_path:
+        raise pytest.UsageError("--ida-daemon is only meaningful when --ida "
+                                "is also provided.")
+    if ida_daemon_stop and not ida_path:
+        raise pytest.UsageError("--ida-daemon-stop is only meaningful when "
+                                "--ida is also provided.")
+    if ida_daemon and ida_record:
+        raise pytest.UsageError("Cannot record while running in an IDA "
+                                "daemon")
+    if ida_workers < 1:
+        raise pytest.UsageError("--ida-workers must be at least 1.")
+    if ida_workers > 1 and not ida_path:
+        raise pytest.UsageError("--ida-workers is only meaningful when --ida "
+                                "is also provided.")
+    if ida_workers > 1 and ida_record:
+        raise pytest.UsageError("Cannot record while running in multiple "
+                                "IDA instances")
+    if ida_daemon and ida_profile:
+        raise pytest.UsageError("Cannot profile while running in an IDA "
+                                "daemon")
+    if ida_workers > 1 and ida_profile:
+        raise pytest.UsageError("Cannot profile while running in multiple "
+                                "IDA instances")
+    if ida_workers > 1 and ida_daemon:
+        raise pytest.UsageError("--ida-workers cannot be combined with "
+                                "--ida-daemon.")
+    if ida_cache_dir and not ida_path:
+        raise pytest.UsageError("--ida-cache-dir is only meaningful when "
+                                "--ida is also provided.")
+    if (ida_cache_dir and os.path.exists(ida_cache_dir) and
+        not os.path.isdir(ida_cache_dir)):
+        raise pytest.UsageError("--ida-cache-dir must point to a directory.")
+    if ida_cache_size is not None and ida_cache_size <= 0:
+        raise pytest.UsageError("--ida-cache-size must be positive.")
+    if ida_cache_size is not None and not ida_cache_dir:
+        raise pytest.UsageError("--ida-cache-size is only meaningful when "
+                                "--ida-cache-dir is also provided.")
+    if ida_qt_offscreen and ida_path:
+        raise pytest.UsageError("--ida-qt-offscreen is only meaningful when "
+                                "not running in an IDA instance.")
+    if ida_qt_offscreen:
+        # no X server is needed
+        config.pluginmanager.set_blocked("xvfb")
+        config.pluginmanager.set_blocked("xvfb.looponfail")
     # TODO: free text ida args?
 
+    if ida_daemon_stop:
+        from . import plugin_internal
+        if plugin_internal.daemon_stop(ida_path, ida_file):
+            print("Stopped the IDA daemon")
+        else:
+            print("No IDA daemon is running")
+        return 0
+
 
 def pytest_configure(config):
-    if config.getoption('--ida'):
+    config.addinivalue_line("markers",
+                            "idapro_isolated_db: restore the IDA database to "
+                            "its state before the test once it is done")
+    config.addinivalue_line("markers",
+                            "idapro_record(include, exclude): only record "
+                            "IDA APIs matching include and not matching "
+                            "exclude glob patterns over module.name during "
+                            "the test")
+    config.addinivalue_line("markers",
+                            "idapro_netnodes(nodes): isolate mocked netnodes "
+                            "from other tests, optionally presetting nodes, "
+                            "a dict mapping names to dicts of tags")
+    config.addinivalue_line("markers",
+                            "idapro_database(description): load a mocked "
+                            "database model from a dict or a JSON file "
+                            "path relative to the test file")
+
+    if config.getoption('--ida') and config.getoption('--ida-workers') > 1:
+        from . import plugin_parallel
+        deferred_plugin = plugin_parallel.ParallelDeferredPlugin(config)
+    elif config.getoption('--ida'):
         from . import plugin_internal
         deferred_plugin = plugin_internal.InternalDeferredPlugin(config)
     elif config.getoption('--ida-replay'):
@@ -1,39 +1,187 @@
+import ast
 import inspect
+import hashlib
 import pytest
 
+ENTRIES_CACHE_KEY = "idapro/entries"
 
-class IDAProEntriesScanner(pytest.Module):
-    def __init__(self, *args, **kwargs):
-        super(IDAProEntriesScanner, self).__init__(*args, **kwargs)
 
-        self.idapro_plugin_entries = set()
-        self.idapro_action_entries = set()
+ENTRY_NAMES = ('PLUGIN_ENTRY', 'action_handler_t')
+
+
+def base_root(node):
+    """Return the name a class base expression starts with"""
+    while isinstance(node, ast.Attribute):
+        node = node.value
+    if isinstance(node, ast.Call):
+        # bases created by calls, such as with_metaclass(...)
+        return base_root(node.func)
+    if isinstance(node, ast.Name):
+        return node.id
+    return None
+
+
+def may_define_entries(source):
+    """Cheaply tell whether python source may define IDA entries, without
+    importing it. Classes inheriting imported classes may inherit
+    action_handler_t indirectly, so those always require a full scan"""
+    has_names = any(name.encode('ascii') in source for name in ENTRY_NAMES)
+    if not has_names and b'import' not in source:
+        return False
+
+    # make sure the names are used by code and not only in comments or strings
+    try:
+        tree = ast.parse(source)
+    except SyntaxError:
+        # let the import report the error
+        return True
+
+    imported = set()
+    classes = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            name = node.id
+        elif isinstance(node, ast.Attribute):
+            name = node.attr
+        elif isinstance(node, ast.FunctionDef):
+            name = node.name
+        elif isinstance(node, ast.ClassDef):
+            name = node.name
+            classes.append(node)
+        elif isinstance(node, ast.alias):
+            name = node.name.split('.')[-1]
+            imported.add(node.asname or node.name.split('.')[0])
+        else:
+            continue
+
+        if name in ENTRY_NAMES:
+            return True
+
+    # names imported with * are unknown, so any base may be imported
+    return any('*' in imported or base_root(base) in imported
+               for cls in classes for base in cls.bases)
+
+
+def scan_entries(module):
+    """Return the plugin entries and action classes defined in module"""
+    plugin_entries = set()
+    action_entries = set()
+    for name, obj in vars(module).items():
+        if inspect.isclass(obj):
+            if any(cls.__name__ == 'action_handler_t'
+                   for cls in inspect.getmro(obj)):
+                action_entries.add(obj)
+        elif name == "PLUGIN_ENTRY":
+            plugin_entries.add(obj)
+    return plugin_entries, action_entries
+
+
+class IDAProEntriesScanner(pytest.Module):
+    """Imports python files which are not collected as test modules, for
+    their entries to be scanned"""
 
-    def istestfunction(self, obj, name):
-        if name == "PLUGIN_ENTRY":
-            self.idapro_plugin_entries.add(obj)
 
-    def istestclass(self, obj, name):
-        if any(cls.__name__ == 'action_handler_t'
-               for cls in inspect.getmro(obj)):
-            self.idapro_action_entries.add(obj)
+def get_marker(item, name):
+    # pytest 3.6 replaced get_marker with get_closest_marker
+    if hasattr(item, 'get_closest_marker'):
+        return item.get_closest_marker(name)
+    return item.get_marker(name)
 
 
 class BasePlugin(object):
+    # markers requesting a fixture of the same name
+    marker_fixtures = ('idapro_isolated_db',)
+
     def __init__(self, *args, **kwargs):
         super(BasePlugin, self).__init__(*args, **kwargs)
         self.idapro_plugin_entries = set()
         self.idapro_action_entries = set()
+        self.entries_cache = None
+
+    @staticmethod
+    def load_entries_cache(config):
+        """Load the cache of files known to define no IDA entries. Workers
+        inside IDA have no cache provider, so the manager provides theirs"""
+        cache = getattr(config, 'cache', None)
+        if cache is not None:
+            return cache.get(ENTRIES_CACHE_KEY, {})
+        return dict(getattr(config.option, 'idapro_entries_cache', None) or {})
 
+    @pytest.hookimpl(hookwrapper=True)
     def pytest_collect_file(self, path, parent):
-        if not path.ext == '.py':
+        outcome = yield
+        if not path.ext == '.py' or outcome.excinfo:
+            return
+
+        if self.entries_cache is None:
+            self.entries_cache = self.load_entries_cache(parent.config)
+
+        # files are identified by their modification time and size, falling
+        # back to their hash when those change
+        stat = path.stat()
+        cached = self.entries_cache.get(str(path))
+        source = None
+        if cached and cached[:2] != [stat.mtime, stat.size]:
+            source = path.read_binary()
+            if cached[2] == hashlib.sha1(source).hexdigest():
+                cached[:2] = [stat.mtime, stat.size]
+            else:
+                cached = None
+        if cached and not cached[3]:
+            # skip files known to have no entries
+            return
+
+        if source is None:
+            source = path.read_binary()
+        has_entries = cached is not None or may_define_entries(source)
+        if has_entries:
+            has_entries = self.collect_entries(path, parent,
+                                               outcome.get_result())
+
+        self.entries_cache[str(path)] = [stat.mtime, stat.size,
+                                         hashlib.sha1(source).hexdigest(),
+                                         has_entries]
+
+    def collect_entries(self, path, parent, collectors):
+        # reuse the module pytest collected for test files, and only import
+        # other files separately
+        module = None
+        for collector in collectors or ():
+            if isinstance(collector, pytest.Module):
+                module = collector
+                break
+        if module is None:
+            module = IDAProEntriesScanner(path, parent)
+
+        try:
+            module_obj = module.obj
+        except (Exception, pytest.skip.Exception):
+            # errors are reported once pytest collects the module itself
+            return True
+
+        plugin_entries, action_entries = scan_entries(module_obj)
+        self.idapro_plugin_entries |= plugin_entries
+        self.idapro_action_entries |= action_entries
+        return bool(plugin_entries or action_entries)
+
+    def pytest_collection_finish(self, session):
+        cache = getattr(session.config, 'cache', None)
+        if cache is not None and self.entries_cache is not None:
+            cache.set(ENTRIES_CACHE_KEY, self.entries_cache)
+
+    def pytest_itemcollected(self, item):
+        fixturenames = getattr(item, 'fixturenames', None)
+        if fixturenames is None:
             return
 
-        scanner = IDAProEntriesScanner(path, parent)
-        scanner.collect()
+        for name in self.marker_fixtures:
+            if get_marker(item, name) and name not in fixturenames:
+                fixturenames.append(name)
 
-        self.idapro_plugin_entries |= scanner.idapro_plugin_entries
-        self.idapro_action_entries |= scanner.idapro_action_entries
+    @pytest.fixture()
+    def idapro_isolated_db(self):
+        # there's no database to isolate outside of IDA
+        yield
 
     def pytest_generate_tests(self, metafunc):
         if 'idapro_plugin_entry' in metafunc.fixturenames:
@@ -1,35 +1,223 @@
 import os
+import json
+import time
+import errno
+import stat
+import getpass
+import hashlib
+import binascii
 import tempfile
+import shutil
 import subprocess
 
-from multiprocessing.connection import Listener
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+try:
+    from multiprocessing.connection import wait
+except ImportError:
+    wait = None
 import platform
 import copy
+import collections
+
+from . import idb_cache
+from . import report_codec
+from .plugin_base import ENTRIES_CACHE_KEY
+from .idapro_internal import transport
+from .idapro_internal.record_module import format_profile
 
 import logging
 
 logging.basicConfig()
 log = logging.getLogger('pytest-idapro.internal.manager')
 
+# Number of hottest APIs reported at the end of a profiled session
+PROFILE_REPORT_LIMIT = 20
+
+# Seconds waited on each connection in turn when waiting for several
+# connections without multiprocessing.connection.wait
+WAIT_POLL_INTERVAL = 0.01
+
+
+def wait_connections(conns, timeout):
+    """Return the connections with pending data, waiting up to timeout
+    seconds for at least one of them"""
+    if wait is not None:
+        # selectors based on posix and WaitForMultipleObjects on windows
+        return wait(conns, timeout)
+
+    # python2 has no multiprocessing.connection.wait, fallback to polling
+    if len(conns) == 1:
+        return list(conns) if conns[0].poll(timeout) else []
+
+    # block shortly on every connection in turn instead of sleeping
+    deadline = time.time() + timeout
+    while True:
+        ready = [conn for conn in conns if conn.poll()]
+        if ready or time.time() > deadline:
+            return ready
+        for conn in conns:
+            if conn.poll(WAIT_POLL_INTERVAL):
+                return [conn]
+
+
+# Environment variable passing the daemon authentication key to IDA
+DAEMON_AUTHKEY_ENV = 'PYTEST_IDAPRO_AUTHKEY'
+
+
+def daemon_name(ida_path, ida_file):
+    """Derive a name unique to an IDA executable and input file, used to find
+    a persistent IDA worker serving them"""
+    key = os.path.abspath(ida_path) + os.pathsep
+    if ida_file:
+        key += os.path.abspath(ida_file)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def daemon_dir():
+    """Return a directory private to the current user, holding daemon
+    sockets, logs and authentication key"""
+    path = os.path.join(tempfile.gettempdir(),
+                        "pytest-idapro-{}".format(getpass.getuser()))
+    try:
+        os.mkdir(path, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    if platform.system() != "Windows":
+        st = os.lstat(path)
+        if (not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or
+            st.st_mode & 0o077):
+            raise RuntimeError("Daemon directory {} is not private to the "
+                               "current user".format(path))
+    return path
+
+
+def daemon_authkey(path):
+    """Return the key authenticating managers to daemons of the current user,
+    generating it on first use"""
+    key_file = os.path.join(path, "authkey")
+    try:
+        fd = os.open(key_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    else:
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(binascii.hexlify(os.urandom(32)))
+
+    while True:
+        with open(key_file, 'r') as fh:
+            authkey = fh.read()
+        # another manager may still be writing a key it just created
+        if len(authkey) == 64:
+            return authkey
+        time.sleep(0.01)
+
+
+def daemon_address(path, name):
+    if platform.system() == "Windows":
+        return r'\\.\pipe\pytest-idapro-{}'.format(name)
+    return os.path.join(path, name + ".sock")
+
+
+def daemon_stop(ida_path, ida_file):
+    """Ask the daemon serving ida_path and ida_file to quit IDA, returning
+    whether such a daemon was running"""
+    path = daemon_dir()
+    address = daemon_address(path, daemon_name(ida_path, ida_file))
+    try:
+        conn = Client(address, authkey=daemon_authkey(path).encode('ascii'))
+    except (IOError, OSError, AuthenticationError):
+        return False
+
+    try:
+        conn.send(('quit', True))
+        response = conn.recv()
+    finally:
+        conn.close()
+    if response != ('quitting',):
+        raise RuntimeError("Unexpected response from IDA daemon: "
+                           "{}".format(response))
+    return True
+
 
 class InternalDeferredPlugin(object):
-    def __init__(self, config):
+    def __init__(self, config, ida_file=None):
         self.ida_path = config.getoption('--ida')
-        self.ida_file = config.getoption('--ida-file')
+        self.ida_file = ida_file or config.getoption('--ida-file')
         self.record_file = config.getoption('--ida-record')
+        self.record_format = config.getoption('--ida-record-format')
+        self.record_compression = config.getoption('--ida-record-compression')
+        self.profile_file = config.getoption('--ida-profile')
+        self.profile_sort = config.getoption('--ida-profile-sort')
+        self.profile = None
         self.keep_ida_running = config.getoption('--ida-keep')
+        self.daemon = config.getoption('--ida-daemon')
 
         self.config = config
         self.session = None
-        self.listener = Listener()
         self.conn = None
-        self.logfile = tempfile.NamedTemporaryFile(delete=False)
         self.proc = None
         self.stop = False
+        self.pending = collections.deque()
+        self.codec_stats = report_codec.CodecStats()
+        self.snapshot_times = []
+        self.workdir = None
+
+        self.idb_cache = None
+        self.idb_cache_key = None
+        cache_dir = config.getoption('--ida-cache-dir')
+        if cache_dir:
+            cache_size = config.getoption('--ida-cache-size')
+            if cache_size is None:
+                cache_size = idb_cache.DEFAULT_MAX_SIZE
+            self.idb_cache = idb_cache.IdbCache(cache_dir,
+                                                cache_size * 1024 * 1024)
+
+        if self.daemon:
+            name = daemon_name(self.ida_path, self.ida_file)
+            path = daemon_dir()
+            self.daemon_address = daemon_address(path, name)
+            self.daemon_authkey = daemon_authkey(path)
+            self.listener = None
+            self.logfile = open(os.path.join(path, name + ".log"), 'a+b')
+            # only report what the daemon logs during this session
+            self.logfile.seek(0, os.SEEK_END)
+        else:
+            self.listener = Listener()
+            self.logfile = tempfile.NamedTemporaryFile(delete=False)
+
+    def daemon_connect(self):
+        try:
+            return Client(self.daemon_address,
+                          authkey=self.daemon_authkey.encode('ascii'))
+        except (IOError, OSError, AuthenticationError):
+            return None
+
+    def daemon_wait(self):
+        while True:
+            conn = self.daemon_connect()
+            if conn is not None:
+                return conn
+
+            if self.proc.poll() is not None:
+                raise RuntimeError("IDA terminated before accepting "
+                                   "connections, worker log: "
+                                   "{}".format(self.logfile.read()))
+            time.sleep(0.1)
 
     def ida_start(self):
-        internal_script = os.path.join(os.path.dirname(__file__),
-                                       "main_idaworker.py")
+        if self.daemon:
+            self.conn = self.daemon_connect()
+            if self.conn is not None:
+                log.info("Attached to running IDA daemon at %s",
+                         self.daemon_address)
+                return
+
+        if self.idb_cache:
+            self.ida_file = self.cache_lookup(self.ida_file)
 
         idapro_internal_dir = os.path.join(os.path.dirname(__file__),
                                            "idapro_internal")
@@ -38,34 +226,73 @@ class InternalDeferredPlugin(object):
         ida_python_init = os.path.join(os.path.dirname(self.ida_path),
                                        "python", "init.py")
 
+        # profiling uses the record module to wrap IDA APIs as well
+        record_module_needed = self.record_file or self.profile_file
         try:
-            if self.record_file:
+            if record_module_needed:
                 self.install_record_module(idapro_internal_dir,
                                            record_module_template,
                                            ida_python_init)
 
-            script_args = '{}'.format(self.listener.address)
-            args = [
-                self.ida_path,
-                # autonomous mode. IDA will not display dialog boxes.
-                # Designed to be used together with -S switch.
-                "-A",
-                "-S\"{}\" {}".format(internal_script, script_args),
-                "-L{}".format(self.logfile.name),
-                # Load user-provided or start with an empty database
-                self.ida_file if self.ida_file else "-t"
-            ]
-            log.debug("worker execution arguments: %s", args)
-            self.proc = subprocess.Popen(args=args)
+            self.ida_launch()
+            self.ida_connect()
+        finally:
+            if record_module_needed:
+                self.uninstall_record_module(record_module_template,
+                                             ida_python_init)
 
+    def cache_lookup(self, ida_file, copy_cached=True):
+        """Return the cached analyzed database for ida_file if one exists,
+        otherwise remember to populate the cache once analysis is done"""
+        if not ida_file or idb_cache.is_database(ida_file):
+            return ida_file
+
+        key = self.idb_cache.key(self.ida_path, ida_file)
+        cached_file = self.idb_cache.lookup(key)
+        if not cached_file:
+            self.idb_cache_key = key
+            return ida_file
+        if not copy_cached:
+            return cached_file
+
+        # IDA modifies databases it opens, use a copy of the cached one
+        self.workdir = tempfile.mkdtemp(prefix="pytest-idapro-")
+        shutil.copy(cached_file, self.workdir)
+        return os.path.join(self.workdir, os.path.basename(cached_file))
+
+    def ida_launch(self):
+        internal_script = os.path.join(os.path.dirname(__file__),
+                                       "main_idaworker.py")
+
+        env = None
+        if self.daemon:
+            script_args = '{} daemon'.format(self.daemon_address)
+            env = dict(os.environ)
+            env[DAEMON_AUTHKEY_ENV] = self.daemon_authkey
+        else:
+            script_args = '{}'.format(self.listener.address)
+        args = [
+            self.ida_path,
+            # autonomous mode. IDA will not display dialog boxes.
+            # Designed to be used together with -S switch.
+            "-A",
+            "-S\"{}\" {}".format(internal_script, script_args),
+            "-L{}".format(self.logfile.name),
+            # Load user-provided or start with an empty database
+            self.ida_file if self.ida_file else "-t"
+        ]
+        log.debug("worker execution arguments: %s", args)
+        self.proc = subprocess.Popen(args=args, env=env)
+
+    def ida_connect(self):
+        if self.daemon:
+            # the daemon will keep listening for future sessions
+            self.conn = self.daemon_wait()
+        else:
             # accept a single connection
             self.conn = self.listener.accept()
             self.listener.close()
             self.listener = None
-        finally:
-            if self.record_file:
-                self.uninstall_record_module(record_module_template,
-                                             ida_python_init)
 
     def ida_finish(self, interrupted):
         self.stop = True
@@ -77,6 +304,10 @@ class InternalDeferredPlugin(object):
         if not self.proc:
             return
 
+        if self.daemon:
+            log.info("Keeping IDA daemon running for future sessions")
+            return
+
         # calling poll to poll execution status and returncode
         self.proc.poll()
         if self.proc.returncode is not None:
@@ -98,8 +329,20 @@ class InternalDeferredPlugin(object):
         root_dir = self.config.rootdir.strpath
         for p in self.config.getoption('file_or_dir'):
             base_paths.add(os.path.abspath(os.path.join(root_dir, p)) + "/")
-        template_params = {'idapro_internal_dir': idapro_internal_dir,
-                           'base_paths': base_paths}
+        record_stream = None
+        if self.record_file and self.record_format == 'jsonl':
+            record_stream = os.path.abspath(self.record_file)
+        template_params = {
+            'idapro_internal_dir': idapro_internal_dir,
+            'base_paths': base_paths,
+            'record_stream': repr(record_stream),
+            'callstack_depth': self.config.getoption('--ida-callstack-depth'),
+            'caller_text': self.config.getoption('--ida-record-caller-text'),
+            'record': bool(self.record_file),
+            'record_include': self.config.getoption('--ida-record-include'),
+            'record_exclude': self.config.getoption('--ida-record-exclude'),
+            'profile': bool(self.profile_file)
+        }
 
         with open(record_module_template, 'r') as fh:
             lines = [line.format(**template_params)
@@ -142,8 +385,9 @@ class InternalDeferredPlugin(object):
         self.send('autoanalysis', 'wait')
         self.recv('autoanalysis', 'done')
 
-    def command_configure(self, config):
+    def command_configure(self, config, args=None, **options):
         option_dict = copy.deepcopy(vars(config.option))
+        option_dict.update(options)
 
         # block interfering plugins
         option_dict['plugins'].append("no:cacheprovider")
@@ -158,12 +402,20 @@ class InternalDeferredPlugin(object):
         del option_dict['ida_file']
         del option_dict['ida_record']
         del option_dict['ida_replay']
+        del option_dict['ida_profile']
 
         if platform.system() == "Windows":
             # remove capturing, this doesn't properly work in windows
             option_dict["plugins"].append("no:terminal")
             option_dict["capture"] = "sys"
-        self.send('configure', config.args, option_dict)
+        # the worker has no cache provider, pass it our cached entries
+        if getattr(config, 'cache', None) is not None:
+            entries_cache = config.cache.get(ENTRIES_CACHE_KEY, {})
+            option_dict['idapro_entries_cache'] = entries_cache
+
+        if args is None:
+            args = config.args
+        self.send('configure', args, option_dict)
         self.recv('configure', 'done')
 
     def command_cmdline_main(self):
@@ -175,25 +427,35 @@ class InternalDeferredPlugin(object):
         # we do not start the session twice
         # self.config.hook.pytest_sessionstart(session=self.session)
 
-    def command_report_header(self):
+    def command_report_header(self, report=True):
         startdir, = self.recv('report', 'header')
-        self.config.hook.pytest_report_header(config=self.config,
-                                              startdir=startdir)
+        if report:
+            self.config.hook.pytest_report_header(config=self.config,
+                                                  startdir=startdir)
 
-    def command_collect(self):
+    def command_collect(self, report=True):
         self.recv('collection', 'start')
-        self.config.hook.pytest_collectstart()
+        if report:
+            self.config.hook.pytest_collectstart()
 
         while True:
             r = self.recv('collection')
-            if r[0] == 'report':
+            if not report:
+                # collection was already reported by another session, only
+                # consume messages until it is done
+                if r[0] == 'finish':
+                    return r[1]
+            elif r[0] == 'report':
                 report = self.deserialize_report("collect", r[1])
                 self.config.hook.pytest_collectreport(report=report)
             elif r[0] == 'finish':
                 collected_tests = r[1]
                 self.session.testscollected = len(collected_tests)
                 self.config.hook.pytest_collection_finish(session=self.session)
-                break
+                return collected_tests
+            elif r[0] == 'cache':
+                if getattr(self.config, 'cache', None) is not None:
+                    self.config.cache.set(ENTRIES_CACHE_KEY, r[1])
             elif r[0] == 'modifyitems':
                 self.config.hook.pytest_collection_modifyitems(
                     session=self.session,
@@ -208,48 +470,98 @@ class InternalDeferredPlugin(object):
     def command_runtest(self):
         while True:
             r = self.recv('runtest')
-            if r[0] == 'logstart':
-                self.config.hook.pytest_runtest_logstart(nodeid=r[1],
-                                                         location=r[2])
-            elif r[0] == 'logreport':
-                report = self.deserialize_report("test", r[1])
-                self.config.hook.pytest_runtest_logreport(report=report)
-            elif r[0] == 'logfinish':
-                # the pytest_runtest_logfinish hook was introduced in pytest3.4
-                if hasattr(self.config.hook, 'pytest_runtest_logfinish'):
-                    self.config.hook.pytest_runtest_logfinish(nodeid=r[1],
-                                                              location=r[2])
-            elif r[0] == 'finish':
+            if r[0] == 'finish':
                 break
-            else:
-                raise RuntimeError("Invalid runtest response received: "
-                                   "{}".format(r))
+            self.handle_runtest(r)
+
+    def handle_runtest(self, r):
+        if r[0] == 'logstart':
+            self.config.hook.pytest_runtest_logstart(nodeid=r[1],
+                                                     location=r[2])
+        elif r[0] == 'logreport':
+            report = self.deserialize_report("test", r[1])
+            for name, value in getattr(report, 'user_properties', ()):
+                if name == 'idapro_isolated_db':
+                    self.snapshot_times.append(value)
+            self.config.hook.pytest_runtest_logreport(report=report)
+        elif r[0] == 'logfinish':
+            # the pytest_runtest_logfinish hook was introduced in pytest3.4
+            if hasattr(self.config.hook, 'pytest_runtest_logfinish'):
+                self.config.hook.pytest_runtest_logfinish(nodeid=r[1],
+                                                          location=r[2])
+        else:
+            raise RuntimeError("Invalid runtest response received: "
+                               "{}".format(r))
 
-    def command_report_terminalsummary(self):
+    def command_report_terminalsummary(self, report=True):
         exitstatus = self.recv('report', 'terminalsummary')
+        if report:
+            self.report_terminalsummary(exitstatus)
+
+    def report_terminalsummary(self, exitstatus, snapshot_times=None):
         tr = self.config.pluginmanager.get_plugin('terminalreporter')
         self.config.hook.pytest_terminal_summary(terminalreporter=tr,
                                                  exitstatus=exitstatus)
 
+        if snapshot_times is None:
+            snapshot_times = self.snapshot_times
+        if snapshot_times and tr:
+            tr.write_line("idapro_isolated_db: {} database snapshots taken "
+                          "in {:.2f}s and restored in "
+                          "{:.2f}s".format(len(snapshot_times),
+                                           sum(t[0] for t in snapshot_times),
+                                           sum(t[1] for t in snapshot_times)))
+
     def command_quit(self):
-        self.send('quit', not self.keep_ida_running)
+        log.info("Report codec: %s", self.codec_stats)
+        self.send('quit', not (self.keep_ida_running or self.daemon))
         self.recv('quitting')
 
+    def command_save_database(self):
+        self.send('save_database',
+                  self.idb_cache.partial_path(self.idb_cache_key))
+        r = self.recv('save_database')
+        if r[0] == 'done':
+            self.idb_cache.add(self.idb_cache_key, r[1])
+        else:
+            log.warning("Failed saving analyzed database to cache")
+
     def command_save_records(self):
-        self.send('save_records', self.record_file)
+        self.send('save_records', self.record_file, self.record_format,
+                  self.record_compression)
         self.recv('save_records', 'done')
 
+    def command_save_profile(self):
+        profile_file = os.path.abspath(self.profile_file)
+        self.send('save_profile', profile_file)
+        if self.recv('save_profile') != ('done',):
+            log.warning("Failed saving IDA API profile")
+            return
+
+        with open(profile_file, 'r') as fh:
+            self.profile = json.load(fh)
+
     def send(self, *s):
         log.debug("Sending: %s", s)
         return self.conn.send(s)
 
     def recv(self, *args):
         try:
-            while not self.conn.poll(1):
-                if self.stop:
-                    raise KeyboardInterrupt
-
-            r = self.conn.recv()
+            while not self.pending:
+                while not wait_connections([self.conn], 1):
+                    if self.stop:
+                        raise KeyboardInterrupt
+
+                r = self.conn.recv()
+                if r[0] == 'payload':
+                    r = transport.read_payload(r[1])
+                # unpack messages batched by the worker
+                if r[0] == 'batch':
+                    self.pending.extend(r[1])
+                else:
+                    self.pending.append(r)
+
+            r = self.pending.popleft()
             log.debug("Received: %s", r)
         except Exception:
             log.critical("Exception during receive, worker output: %s",
@@ -263,63 +575,64 @@ class InternalDeferredPlugin(object):
         return r[len(args):]
 
     def deserialize_report(self, reporttype, report):
-        from _pytest.runner import TestReport, CollectReport
-        from pytest import Item
-        if 'result' in report:
-            newresult = []
-            for item in report['result']:
-                item_obj = Item(item['name'], config=self.config,
-                                session=self.session)
-                newresult.append(item_obj)
-            report['result'] = newresult
-        if reporttype == "test":
-            return TestReport(**report)
-        elif reporttype == "collect":
-            return CollectReport(**report)
+        return report_codec.decode_report(reporttype, report, self.config,
+                                          self.session, self.codec_stats)
+
+    def ida_prepare(self):
+        self.command_ping()
+        self.command_dependencies()
+        self.command_autoanalysis_wait()
+        if self.idb_cache_key:
+            self.command_save_database()
+
+    def run_session(self, args=None, terminal_summary=True, **options):
+        """Run a complete pytest session inside IDA, returning the node ids
+        of collected tests"""
+        self.command_configure(self.config, args, **options)
+        self.command_cmdline_main()
+
+        self.command_session_start()
+        self.command_report_header()
+
+        collected_tests = self.command_collect()
+        response = self.recv()
+
+        if response == ('runtest', 'start'):
+            self.command_runtest()
+            exitstatus = self.recv('session', 'finish')
+        elif response[:2] == ('session', 'finish'):
+            exitstatus = response[2]
         else:
-            raise RuntimeError("Invalid report type: {}".format(reporttype))
+            raise RuntimeError("Unexpected response: {}".format(response))
 
-    def pytest_runtestloop(self, session):
-        self.session = session
+        # TODO: The same exit status will be derived by pytest. might be
+        # useful to make sure they match
+        del exitstatus
+
+        self.command_report_terminalsummary(terminal_summary)
 
+        self.recv('cmdline_main', 'finish')
+        return collected_tests
+
+    def silence_cov(self):
         if self.config.pluginmanager.has_plugin('_cov'):
             from .idapro_internal.cov import CovReadOnlyController
             cov_plugin = self.config.pluginmanager.get_plugin('_cov')
             CovReadOnlyController.silence(cov_plugin.cov_controller)
 
+    def pytest_runtestloop(self, session):
+        self.session = session
+        self.silence_cov()
+
         try:
             self.ida_start()
-            self.command_ping()
-
-            self.command_dependencies()
-            self.command_autoanalysis_wait()
-            self.command_configure(self.config)
-            self.command_cmdline_main()
-
-            self.command_session_start()
-            self.command_report_header()
-
-            self.command_collect()
-            response = self.recv()
-
-            if response == ('runtest', 'start'):
-                self.command_runtest()
-                exitstatus = self.recv('session', 'finish')
-            elif response[:2] == ('session', 'finish'):
-                exitstatus = response[2]
-            else:
-                raise RuntimeError("Unexpected response: {}".format(response))
-
-            # TODO: The same exit status will be derived by pytest. might be
-            # useful to make sure they match
-            del exitstatus
-
-            self.command_report_terminalsummary()
-
-            self.recv('cmdline_main', 'finish')
+            self.ida_prepare()
+            self.run_session()
 
             if self.record_file:
                 self.command_save_records()
+            if self.profile_file:
+                self.command_save_profile()
 
             self.command_quit()
         except Exception:
@@ -329,9 +642,25 @@ class InternalDeferredPlugin(object):
 
         return True
 
+    def pytest_terminal_summary(self, terminalreporter):
+        # also called while forwarding the worker's terminal summary, before
+        # the profile is saved
+        if self.profile is None:
+            return
+
+        terminalreporter.section("IDA API profile")
+        for line in format_profile(self.profile, self.profile_sort,
+                                   PROFILE_REPORT_LIMIT):
+            terminalreporter.write_line(line)
+        terminalreporter.write_line("Full profile written to {}".format(
+            self.profile_file))
+
     def pytest_sessionfinish(self, exitstatus):
         self.ida_finish(exitstatus == 2)  # EXIT_ITERRUPTED
 
+        if self.workdir and not (self.keep_ida_running or self.daemon):
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
     @staticmethod
     def pytest_collection():
         # prohibit collection of test items in master process. test collection
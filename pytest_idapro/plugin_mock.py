@@ -1,57 +1,104 @@
+import os
 import sys
 import threading
 
 from . import idapro_mock
 
-from PyQt5 import QtWidgets
 import pytest
 
-from .plugin_base import BasePlugin
+from .plugin_base import BasePlugin, get_marker
 
-modules_list = ['ida_allins', 'ida_area', 'ida_auto', 'ida_bytes', 'ida_dbg',
-                'ida_diskio', 'ida_entry', 'ida_enum', 'ida_expr', 'ida_fixup',
-                'ida_fpro', 'ida_frame', 'ida_funcs', 'ida_gdl', 'ida_graph',
-                'ida_hexrays', 'ida_ida', 'ida_idaapi', 'ida_idd', 'ida_idp',
-                'ida_ints', 'ida_kernwin', 'ida_lines', 'ida_loader',
-                'ida_moves', 'ida_nalt', 'ida_name', 'ida_netnode',
-                'ida_offset', 'ida_pro', 'ida_problems', 'ida_queue',
-                'ida_registry', 'ida_search', 'ida_segment', 'ida_segregs',
-                'ida_srarea', 'ida_strlist', 'ida_struct', 'ida_typeinf',
-                'ida_ua', 'ida_xref', 'ida_range']
-modules_list.extend(['idaapi', 'idc', 'idautils'])
+modules_list = idapro_mock.modules_list
+
+
+class MockModuleFinder(object):
+    """A meta path finder providing IDA modules only once they are imported,
+    using get_module to create them"""
+    def __init__(self, get_module):
+        self.get_module = get_module
+
+    def find_spec(self, fullname, path=None, target=None):
+        if fullname not in modules_list:
+            return None
+
+        import importlib.util
+        return importlib.util.spec_from_loader(fullname, self)
+
+    def create_module(self, spec):
+        return self.get_module(spec.name)
+
+    def exec_module(self, module):
+        pass
+
+    # python2 import protocol
+    def find_module(self, fullname, path=None):
+        return self if fullname in modules_list else None
+
+    def load_module(self, fullname):
+        if fullname not in sys.modules:
+            sys.modules[fullname] = self.get_module(fullname)
+        return sys.modules[fullname]
 
 
 class MockDeferredPlugin(BasePlugin):
+    marker_fixtures = BasePlugin.marker_fixtures + ('idapro_netnodes',
+                                                    'idapro_database')
+
     def __init__(self, *args, **kwargs):
         super(MockDeferredPlugin, self).__init__(*args, **kwargs)
         self.app = None
         self.app_menu = None
         self.app_window = None
         self.app_thread = None
+        self.offscreen = False
+        self.finder = MockModuleFinder(self.get_module)
+
+    def pytest_configure(self, config):
+        self.offscreen = config.getoption('--ida-qt-offscreen')
+
+        # modules are created once imported by tests
+        sys.meta_path.insert(0, self.finder)
 
-    def pytest_configure(self):
-        for module_name in modules_list:
-            sys.modules[module_name] = self.get_module(module_name)
+        # Qt based mock classes require a running Qt application
+        idapro_mock.app_start = self.app_start
 
-    @staticmethod
-    def get_module(module_name):
-        return getattr(idapro_mock, module_name)
+    def get_module(self, module_name):
+        return idapro_mock.get_module(module_name)
+
+    def pytest_unconfigure(self):
+        if self.finder in sys.meta_path:
+            sys.meta_path.remove(self.finder)
+        idapro_mock.app_start = None
 
-    @staticmethod
-    def pytest_unconfigure():
         for module in modules_list:
             if module not in sys.modules:
                 continue
             del sys.modules[module]
 
+        # netnodes modified during the session are only written once
+        netnode = sys.modules.get(idapro_mock.__name__ + '.ida_netnode')
+        if netnode:
+            netnode.netnode_store.flush()
+
         # TODO: if this is deleted here it should also be created in
         # pytest_configure instead of idapro_mock.idc
-        if idapro_mock.idc.tempidadir:
+        idc = sys.modules.get(idapro_mock.__name__ + '.idc')
+        if idc and idc.tempidadir:
             import shutil
-            shutil.rmtree(idapro_mock.idc.tempidadir)
-            idapro_mock.idc.tempidadir = None
+            shutil.rmtree(idc.tempidadir)
+            idc.tempidadir = None
+
+    def app_start(self):
+        """Create the Qt application on first use, so tests that do not
+        need one do not pay for it"""
+        if self.app:
+            return
+
+        if self.offscreen:
+            os.environ['QT_QPA_PLATFORM'] = 'offscreen'
+
+        from PyQt5 import QtWidgets
 
-    def pytest_sessionstart(self):
         # Create main Qt objects
         self.app = QtWidgets.QApplication([])
         qmdiarea = QtWidgets.QMdiArea()
@@ -67,18 +114,51 @@ class MockDeferredPlugin(BasePlugin):
         self.app_thread = threading.Thread(target=self.app.exec_)
         self.app_thread.start()
 
+    @pytest.fixture()
+    def idapro_netnodes(self, request):
+        """Isolate netnodes created by the test from any other test. Netnodes
+        provided to the idapro_netnodes marker are preset"""
+        from .idapro_mock.ida_netnode import netnode_store
+
+        with netnode_store.isolate():
+            marker = get_marker(request.node, 'idapro_netnodes')
+            if marker and marker.args:
+                netnode_store.preset(marker.args[0])
+            yield netnode_store
+
+    @pytest.fixture()
+    def idapro_database(self, request):
+        """Provide a mocked database model for the test, loaded from the
+        description or JSON file (relative to the test's file) provided to
+        the idapro_database marker"""
+        from .idapro_mock.database import database
+
+        with database.isolate():
+            marker = get_marker(request.node, 'idapro_database')
+            if marker and marker.args:
+                description = marker.args[0]
+                if not isinstance(description, dict):
+                    description = os.path.join(str(request.fspath.dirpath()),
+                                               description)
+                database.load(description)
+            yield database
+
     @pytest.fixture()
     def idapro_app(self):
+        self.app_start()
         return self.app
 
     @pytest.fixture()
     def idapro_app_window(self):
+        self.app_start()
         return self.app_window
 
     @pytest.fixture()
     def idapro_app_menu(self):
+        self.app_start()
         return self.app_menu
 
     @pytest.fixture()
     def idapro_app_thread(self):
+        self.app_start()
         return self.app_thread
@@ -0,0 +1,151 @@
+import os
+import shutil
+import tempfile
+
+from .plugin_internal import InternalDeferredPlugin, wait_connections
+
+import logging
+
+log = logging.getLogger('pytest-idapro.internal.parallel')
+
+
+def wait_workers(workers, timeout):
+    """Return the workers with pending messages, waiting up to timeout
+    seconds for at least one of them"""
+    # messages already received in a batch are ready without waiting
+    ready = [w for w in workers if w.pending]
+    if ready:
+        return ready
+
+    ready = wait_connections([w.conn for w in workers], timeout)
+    return [w for w in workers if w.conn in ready]
+
+
+class ParallelDeferredPlugin(InternalDeferredPlugin):
+    """Run tests over several IDA instances. The first instance collects
+    tests for the whole session, after which collected tests are split
+    between all instances and executed concurrently"""
+    def __init__(self, config):
+        worker_count = config.getoption('--ida-workers')
+        super(ParallelDeferredPlugin, self).__init__(config)
+
+        ida_file = self.ida_file
+        if self.idb_cache:
+            # cached databases are copied for every instance anyway
+            ida_file = self.cache_lookup(ida_file, copy_cached=False)
+
+        # every IDA instance needs its own copy of the input file, as IDA
+        # creates the database files next to it
+        self.tempdir = tempfile.mkdtemp(prefix="pytest-idapro-")
+        ida_files = [self.copy_ida_file(ida_file, i)
+                     for i in range(worker_count)]
+
+        self.ida_file = ida_files[0]
+        self.workers = [self]
+        for worker_file in ida_files[1:]:
+            self.workers.append(InternalDeferredPlugin(config, worker_file))
+
+    def copy_ida_file(self, ida_file, index):
+        if not ida_file:
+            return None
+
+        worker_dir = os.path.join(self.tempdir, str(index))
+        os.mkdir(worker_dir)
+        shutil.copy(ida_file, worker_dir)
+        return os.path.join(worker_dir, os.path.basename(ida_file))
+
+    def split_tests(self, nodeids):
+        root_dir = self.config.rootdir.strpath
+        nodeids = [os.path.join(root_dir, nodeid) for nodeid in nodeids]
+
+        # keep neighbouring tests together so module and class scoped
+        # fixtures are set up by as few instances as possible
+        count = len(self.workers)
+        return [nodeids[i * len(nodeids) // count:
+                        (i + 1) * len(nodeids) // count]
+                for i in range(count)]
+
+    @staticmethod
+    def worker_start(worker, nodeids):
+        """Start a session running the provided tests in worker, returning
+        True if the worker proceeded to run tests"""
+        worker.command_configure(worker.config, nodeids)
+        worker.command_cmdline_main()
+        worker.command_session_start()
+        worker.command_report_header(False)
+        worker.command_collect(False)
+
+        response = worker.recv()
+        if response == ('runtest', 'start'):
+            return True
+        elif response[:2] == ('session', 'finish'):
+            ParallelDeferredPlugin.worker_finish(worker, True)
+            return False
+        raise RuntimeError("Unexpected response: {}".format(response))
+
+    @staticmethod
+    def worker_finish(worker, session_finished=False):
+        """Consume the remaining messages of a worker's session"""
+        if not session_finished:
+            worker.recv('session', 'finish')
+
+        exitstatus = worker.recv('report', 'terminalsummary')
+        worker.recv('cmdline_main', 'finish')
+        return exitstatus
+
+    def pytest_runtestloop(self, session):
+        self.session = session
+        self.silence_cov()
+
+        try:
+            for worker in self.workers:
+                worker.session = session
+                worker.ida_launch()
+            for worker in self.workers:
+                worker.ida_connect()
+                worker.ida_prepare()
+
+            nodeids = self.run_session(terminal_summary=False,
+                                       collectonly=True)
+            if self.config.option.collectonly or not nodeids:
+                nodeids = []
+
+            active = []
+            for worker, worker_nodeids in zip(self.workers,
+                                              self.split_tests(nodeids)):
+                if worker_nodeids and self.worker_start(worker,
+                                                        worker_nodeids):
+                    active.append(worker)
+
+            exitstatus = ()
+            while active:
+                if self.stop:
+                    raise KeyboardInterrupt
+
+                for worker in wait_workers(active, 1):
+                    r = worker.recv('runtest')
+                    if r[0] == 'finish':
+                        exitstatus = self.worker_finish(worker)
+                        active.remove(worker)
+                    else:
+                        worker.handle_runtest(r)
+
+            snapshot_times = sum((w.snapshot_times for w in self.workers), [])
+            self.report_terminalsummary(exitstatus, snapshot_times)
+
+            for worker in self.workers:
+                worker.command_quit()
+        except Exception:
+            log.exception("Caught exception during main test loop")
+            for worker in self.workers:
+                worker.ida_finish(True)
+            raise
+
+        return True
+
+    def pytest_sessionfinish(self, exitstatus):
+        for worker in self.workers:
+            worker.ida_finish(exitstatus == 2)  # EXIT_ITERRUPTED
+
+        if not self.keep_ida_running:
+            shutil.rmtree(self.tempdir, ignore_errors=True)
@@ -1,5 +1,4 @@
 import os
-import json
 
 from .idapro_internal import replay_module
 
@@ -17,20 +16,21 @@ class ReplayDeferredPlugin(MockDeferredPlugin):
         self.config = config
         self.session = None
 
-        with open(self.replay_file, 'rb') as fh:
-            self.records = json.load(fh)
+        self.records = replay_module.load_records(self.replay_file)
 
         base_paths = set()
         root_dir = self.config.rootdir.strpath
         for p in self.config.getoption('file_or_dir'):
             base_paths.add(os.path.abspath(os.path.join(root_dir, p)) + "/")
-        replay_module.setup(base_paths)
+        replay_module.setup(base_paths, config.getoption('--ida-replay-mode'),
+                            config.getoption('--ida-callstack-depth'),
+                            config.getoption('--ida-replay-memo-size'))
 
     def get_module(self, module_name):
         module_name = module_aliases.get(module_name, module_name)
         module_record = self.records[module_name]
         return replay_module.module_replay(module_name, module_record)
 
-    @staticmethod
-    def pytest_collection_finish(session):
+    def pytest_collection_finish(self, session):
         session.items.sort(key=lambda i: i.nodeid)
+        super(ReplayDeferredPlugin, self).pytest_collection_finish(session)
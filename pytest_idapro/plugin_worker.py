@@ -1,10 +1,19 @@
+import os
+import sys
+import time
+
 import pytest
 import _pytest
 
 try:
-    from plugin_base import BasePlugin
+    from plugin_base import BasePlugin, get_marker
+    import report_codec
 except ImportError:
-    from .plugin_base import BasePlugin
+    from .plugin_base import BasePlugin, get_marker
+    from . import report_codec
+
+# Seconds to wait for IDA to restore a database snapshot
+RESTORE_SNAPSHOT_TIMEOUT = 60
 
 
 class WorkerPlugin(BasePlugin):
@@ -20,7 +29,7 @@ class WorkerPlugin(BasePlugin):
         self.worker.send('collection', 'start')
 
     def pytest_collectreport(self, report):
-        serialized_report = self.serialize_report(report)
+        serialized_report = report_codec.encode_report(report)
         self.worker.send('collection', 'report', serialized_report)
 
     def pytest_collection_modifyitems(self, items):
@@ -33,6 +42,10 @@ class WorkerPlugin(BasePlugin):
         self.worker.send('collection', 'deselected', items)
 
     def pytest_collection_finish(self, session):
+        # persisted by the manager for following sessions
+        if self.entries_cache is not None:
+            self.worker.send('collection', 'cache', self.entries_cache)
+
         session.items.sort(key=lambda i: i.nodeid)
         items = [i.nodeid for i in session.items]
         self.worker.send('collection', 'finish', items)
@@ -43,17 +56,32 @@ class WorkerPlugin(BasePlugin):
         yield
         self.worker.send('runtest', 'finish')
 
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_protocol(self, item):
+        marker = get_marker(item, 'idapro_record')
+        # record_module is only loaded by IDA's init.py when recording
+        record_module = sys.modules.get('record_module')
+        if marker is None or record_module is None:
+            yield
+            return
+
+        with record_module.filtered(*marker.args, **marker.kwargs):
+            yield
+
     def pytest_runtest_logstart(self, nodeid, location):
-        self.worker.send('runtest', 'logstart', nodeid, location)
+        # runtest messages are batched, batches are only split between tests
+        self.worker.batch_boundary()
+        self.worker.send_batched('runtest', 'logstart', nodeid, location)
 
     # the pytest_runtest_logfinish hook was introduced in pytest 3.4
     if hasattr(_pytest.hookspec, "pytest_runtest_logfinish"):
         def pytest_runtest_logfinish(self, nodeid, location):
-            self.worker.send('runtest', 'logfinish', nodeid, location)
+            self.worker.send_batched('runtest', 'logfinish', nodeid,
+                                     location)
 
     def pytest_runtest_logreport(self, report):
-        serialized_report = self.serialize_report(report)
-        self.worker.send('runtest', 'logreport', serialized_report)
+        serialized_report = report_codec.encode_report(report)
+        self.worker.send_batched('runtest', 'logreport', serialized_report)
 
     # unsupported
     def pytest_internalerror(self, excrepr, excinfo):
@@ -78,22 +106,50 @@ class WorkerPlugin(BasePlugin):
         from PyQt5 import QtWidgets
         yield QtWidgets.qApp
 
-    @staticmethod
-    def serialize_report(report):
-        from py.path import local
-        from pytest import Item
-
-        d = vars(report).copy()
-        if hasattr(report.longrepr, "toterminal"):
-            d['longrepr'] = str(report.longrepr)
-        else:
-            d['longrepr'] = report.longrepr
-
-        for name, value in d.items():
-            if isinstance(value, local):
-                d[name] = str(value)
-            elif name == "result":
-                d['result'] = [{'name': item.name} for item in d['result']
-                               if isinstance(item, Item)]
-
-        return d
+    @pytest.fixture()
+    def idapro_isolated_db(self, request):
+        import ida_kernwin
+
+        start = time.time()
+        snapshot = ida_kernwin.snapshot_t()
+        snapshot.desc = "pytest-idapro: {}".format(request.node.nodeid)
+        success, error = ida_kernwin.take_database_snapshot(snapshot)
+        if not success:
+            pytest.fail("Failed taking database snapshot: {}".format(error))
+        snapshot_time = time.time() - start
+
+        yield
+
+        from PyQt5 import QtCore
+
+        start = time.time()
+        restored = []
+        loop = QtCore.QEventLoop()
+
+        def callback(error, userdata):
+            restored.append(error)
+            loop.quit()
+
+        if not ida_kernwin.restore_database_snapshot(snapshot, callback,
+                                                     None):
+            pytest.fail("Failed restoring database snapshot")
+
+        # restoring is asynchronous and completes from the event loop
+        if not restored:
+            QtCore.QTimer.singleShot(int(RESTORE_SNAPSHOT_TIMEOUT * 1000),
+                                     loop.quit)
+            loop.exec_()
+        if not restored:
+            pytest.fail("Timed out restoring database snapshot after "
+                        "{} seconds".format(RESTORE_SNAPSHOT_TIMEOUT))
+        if restored[0]:
+            pytest.fail("Failed restoring database snapshot: "
+                        "{}".format(restored[0]))
+        restore_time = time.time() - start
+
+        # the restored snapshot is no longer needed
+        if os.path.isfile(snapshot.filename):
+            os.remove(snapshot.filename)
+
+        request.node.user_properties.append(
+            ('idapro_isolated_db', (snapshot_time, restore_time)))
@@ -0,0 +1,118 @@
+"""Encoding of pytest reports sent from a worker inside IDA to the manager.
+
+Reports are encoded using pytest's own structured report serialization when
+available, keeping tracebacks intact, and fall back to copying report
+attributes with longrepr flattened to a string on older pytest versions.
+Collection results are sent as (nodeid, name) descriptors only.
+"""
+import time
+
+import pytest
+
+REPORT_CODEC_VERSION = 1
+
+
+def encode_report(report):
+    start = time.time()
+
+    result = getattr(report, 'result', None)
+    if result is not None:
+        result = [(item.nodeid, item.name) for item in result
+                  if isinstance(item, pytest.Item)]
+
+    if hasattr(report, '_to_json'):
+        encoding = 'json'
+        data = report._to_json()
+        data.pop('result', None)
+    else:
+        encoding = 'vars'
+        data = encode_report_vars(report)
+
+    return {'version': REPORT_CODEC_VERSION,
+            'encoding': encoding,
+            'report': data,
+            'result': result,
+            'encode_time': time.time() - start}
+
+
+def encode_report_vars(report):
+    from py.path import local
+
+    data = {}
+    for name, value in vars(report).items():
+        if name == 'result':
+            continue
+        elif name == 'longrepr' and hasattr(value, 'toterminal'):
+            value = str(value)
+        elif isinstance(value, local):
+            value = str(value)
+        data[name] = value
+    return data
+
+
+class CollectedItem(pytest.Item):
+    """A lightweight stand-in for an item collected by a worker"""
+    def runtest(self):
+        pytest.fail("{} is a test collected inside IDA, it only runs inside "
+                    "IDA".format(self.nodeid), pytrace=False)
+
+
+def decode_item(nodeid, name, config, session):
+    # Node.from_parent was introduced in pytest 5.4, replacing constructing
+    # nodes directly
+    if hasattr(CollectedItem, 'from_parent'):
+        return CollectedItem.from_parent(session, name=name, nodeid=nodeid)
+    return CollectedItem(name, config=config, session=session, nodeid=nodeid)
+
+
+def decode_report(reporttype, encoded, config, session, stats=None):
+    from _pytest.runner import TestReport, CollectReport
+
+    start = time.time()
+
+    if encoded.get('version') != REPORT_CODEC_VERSION:
+        raise RuntimeError("Unsupported report codec version: "
+                           "{}".format(encoded.get('version')))
+    if reporttype == "test":
+        report_class = TestReport
+    elif reporttype == "collect":
+        report_class = CollectReport
+    else:
+        raise RuntimeError("Invalid report type: {}".format(reporttype))
+
+    data = encoded['report']
+    if reporttype == "collect":
+        data['result'] = []
+    if encoded['encoding'] == 'json':
+        report = report_class._from_json(data)
+    elif encoded['encoding'] == 'vars':
+        report = report_class(**data)
+    else:
+        raise RuntimeError("Invalid report encoding: "
+                           "{}".format(encoded['encoding']))
+
+    if encoded['result'] is not None:
+        report.result = [decode_item(nodeid, name, config, session)
+                         for nodeid, name in encoded['result']]
+
+    if stats is not None:
+        stats.add(encoded['encode_time'], time.time() - start)
+    return report
+
+
+class CodecStats(object):
+    """Counters of time spent encoding and decoding reports"""
+    def __init__(self):
+        self.count = 0
+        self.encode_time = 0.0
+        self.decode_time = 0.0
+
+    def add(self, encode_time, decode_time):
+        self.count += 1
+        self.encode_time += encode_time
+        self.decode_time += decode_time
+
+    def __str__(self):
+        return ("{} reports encoded in {:.3f}s and decoded in "
+                "{:.3f}s".format(self.count, self.encode_time,
+                                 self.decode_time))
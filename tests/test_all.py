@@ -1,2 +1,569 @@
 def test_import():
     import pytest_idapro.idapro_mock
+
+
+def test_replay_instance_index():
+    from pytest_idapro.idapro_internal import replay_module
+
+    def call(args, call_index, line=10):
+        callstack = [{'caller_file': 'test_a.py', 'caller_line': line,
+                      'caller_function': 'test_a', 'caller_text': None}]
+        return {'instance_desc': {'name': 'get_name', 'args': args,
+                                  'kwargs': {}, 'callstack': callstack,
+                                  'call_index': call_index}}
+
+    instances = [call([0x1000], 0), call([0x2000], 1), call([0x1000], 2),
+                 call([0x3000], 3, line=12)]
+    index = replay_module.InstanceIndex(instances)
+
+    def select(args, call_index, line=10):
+        callstack = [('test_a.py', line, 'test_a')]
+        selected = index.select('get_name', args, {}, callstack, call_index)
+        expected = sorted(map(lambda i: replay_module.instance_score(
+            i, 'get_name', args, {}, callstack, call_index), instances),
+            key=lambda x: x[0])
+        assert selected[0] == expected[0]
+        return selected[0]
+
+    assert select([0x1000], 2) == (0, instances[2])
+    assert select([0x1000], 1) == (5, instances[0])
+    assert select([0x3000], 3, line=11) == (1, instances[3])
+    assert select([0x4000], 1)[1] is instances[1]
+    assert index.select_next('get_name', [0x2000], {},
+                             [('test_a.py', 10, 'test_a')], 1)[0][1] is \
+        instances[1]
+    assert index.select_next('get_name', [0x1000], {},
+                             [('test_a.py', 99, 'test_a')], 0)[0][1] is \
+        instances[2]
+    assert index.select_next('get_name', [0x1000], {},
+                             [('test_a.py', 10, 'test_a')], 2)[0][1] is \
+        instances[2]
+
+    # a shorter callstack is only scored for its common prefix, so it may
+    # beat the bucket of the call
+    def caller(line, function):
+        return {'caller_file': 't.py', 'caller_line': line,
+                'caller_function': function, 'caller_text': None}
+
+    instances = [{'instance_desc': {
+        'name': 'get_name', 'args': [], 'kwargs': {}, 'call_index': 0,
+        'callstack': callstack}} for callstack in (
+            [caller(3, 'test'), caller(20, 'helper')], [caller(2, 'test')])]
+    index = replay_module.InstanceIndex(instances)
+    assert index.select('get_name', [], {},
+                        [('t.py', 2, 'test'), ('t.py', 28, 'helper')],
+                        0)[0] == (0, instances[1])
+    # matches agree with scoring every instance
+    assert index.select('get_name', [], {},
+                        [('t.py', 4, 'test'), ('t.py', 20, 'helper')],
+                        0)[0] == (1, instances[0])
+    assert index.select('get_name', [], {},
+                        [('u.py', 2, 'test'), ('t.py', 21, 'helper')],
+                        0)[0] == (100, instances[1])
+
+    # keyword arguments match regardless of their order
+    instance = {'instance_desc': {
+        'name': 'get_name', 'args': [], 'kwargs': {'ea': 1, 'flags': 2},
+        'call_index': 0, 'callstack': []}}
+    index = replay_module.InstanceIndex([instance])
+    assert index.select('get_name', [], {'flags': 2, 'ea': 1}, [],
+                        0) == [(0, instance)]
+
+
+def test_records_formats(tmpdir):
+    from pytest_idapro.idapro_internal import record_module, replay_module
+
+    records = {'idc': {'value_type': 'module',
+                       'BADADDR': {'value_type': 'value',
+                                   'raw_data': 0xffffffff},
+                       'GetFunctionName': {'value_type': 'function',
+                                           'call_data': [], 'call_count': 1}}}
+    call_data = records['idc']['GetFunctionName']['call_data']
+    for i in range(2):
+        call_data.append({'instance_desc': {
+            'name': 'GetFunctionName', 'args': [i - 1], 'kwargs': {},
+            'callstack': [], 'callback': {}, 'call_index': i,
+            'retval': {'value_type': 'value', 'raw_data': u"sub_\xe9"}}})
+
+    for records_format in ('json', 'jsonl', 'indexed', 'binary'):
+        records_file = str(tmpdir.join(records_format))
+        with open(records_file, 'wb') as fh:
+            record_module.write_records(records, fh, records_format, 'gzip')
+
+        loaded = replay_module.load_records(records_file)
+        assert {k: dict(v) for k, v in loaded.items()} == records
+
+
+def test_idb_cache(tmpdir):
+    import os
+    from pytest_idapro import idb_cache
+
+    ida_path = tmpdir.join("ida64")
+    ida_path.write("ida")
+    input_file = tmpdir.join("input.exe")
+    input_file.write("MZ")
+    other_file = tmpdir.join("other.exe")
+    other_file.write("MZ\0")
+
+    cache = idb_cache.IdbCache(str(tmpdir.join("cache")), 10)
+    key = cache.key(str(ida_path), str(input_file))
+    assert key == cache.key(str(ida_path), str(input_file))
+    assert key != cache.key(str(ida_path), str(other_file))
+    os.utime(str(ida_path), (0, 0))
+    assert key != cache.key(str(ida_path), str(input_file))
+
+    assert cache.lookup(key) is None
+    paths = []
+    for i, name in enumerate(("a", "b", "c")):
+        saved_path = cache.partial_path(name) + ".i64"
+        with open(saved_path, 'wb') as fh:
+            fh.write(b"\0" * 4)
+        assert sorted(cache.entries()) == paths
+        paths.append(cache.add(name, saved_path))
+        os.utime(paths[-1], (i, i))
+        assert cache.lookup(name) == paths[-1]
+        os.utime(paths[-1], (i, i))
+
+    # the least recently used entry is evicted, "a" was added first
+    assert sorted(cache.entries()) == paths[1:]
+    assert cache.lookup("a") is None
+    assert cache.lookup("b") == paths[1]
+
+
+def test_netnode_store(tmpdir):
+    from pytest_idapro.idapro_mock import ida_netnode
+
+    store = ida_netnode.NetnodeStore(str(tmpdir.join("netnodes")))
+    original_store = ida_netnode.netnode_store
+    ida_netnode.netnode_store = store
+    try:
+        node = ida_netnode.netnode("$ test", do_create=True)
+        node.supset(1, b"\x00\x01")
+        node.altset(2, 0x1000)
+        node.hashset("key", "value")
+        assert ida_netnode.netnode("$ test").altval(2) == 0x1000
+        ida_netnode.netnode("$ killed", do_create=True).altset(0, 1)
+        store.flush()
+        ida_netnode.netnode("$ killed").kill()
+        assert store.get("$ killed") is None
+
+        # writing through a killed netnode object creates it again
+        node = ida_netnode.netnode("$ rewritten", do_create=True)
+        node.altset(0, 1)
+        node.kill()
+        assert node.altval(0) == 0
+        node.altset(1, 2)
+        assert ida_netnode.netnode("$ rewritten").altval(1) == 2
+        assert ida_netnode.netnode("$ rewritten").altval(0) == 0
+
+        with store.isolate():
+            store.preset({"$ preset": {ida_netnode.stag: {0: b"preset"}}})
+            assert ida_netnode.netnode("$ preset").supval(0) == b"preset"
+            assert store.get("$ test") is None
+        assert store.get("$ preset") is None
+
+        store.flush()
+        reloaded = ida_netnode.NetnodeStore(store.path)
+        ida_netnode.netnode_store = reloaded
+        node = ida_netnode.netnode("$ test")
+        assert node.supval(1) == b"\x00\x01"
+        assert node.hashstr("key") == "value"
+        assert node.altval(3) == 0
+        assert reloaded.get("$ killed") is None
+        assert ida_netnode.netnode("$ rewritten").altval(1) == 2
+    finally:
+        ida_netnode.netnode_store = original_store
+
+
+def test_database_model():
+    from pytest_idapro.idapro_mock import (database, ida_funcs, ida_bytes,
+                                           ida_name, ida_segment, idautils)
+
+    with database.database.isolate() as db:
+        db.load({'segments': [{'start': '0x1000', 'end': '0x2000',
+                               'name': '.text', 'bytes': '5589e5c3'}],
+                 'functions': [{'start': '0x1000', 'end': '0x1004',
+                                'name': 'main',
+                                'chunks': [['0x1800', '0x1810']]},
+                               {'start': '0x1100', 'end': '0x1120'}],
+                 'names': {'0x1900': 'data'}})
+
+        assert list(idautils.Functions()) == [0x1000, 0x1100]
+        assert list(idautils.Chunks(0x1000)) == [(0x1000, 0x1004),
+                                                 (0x1800, 0x1810)]
+        assert ida_funcs.get_func(0x1808).start_ea == 0x1000
+        assert ida_funcs.get_func(0x1010) is None
+        assert ida_funcs.get_fchunk(0x1808).flags & ida_funcs.FUNC_TAIL
+        assert ida_name.get_name(0x1100) == "sub_1100"
+        assert ida_name.get_name_ea(0, "data") == 0x1900
+        assert ida_bytes.get_bytes(0x1000, 4) == b"\x55\x89\xe5\xc3"
+        assert ida_bytes.get_dword(0x1000) == 0xc3e58955
+        assert ida_segment.getseg(0x1fff).name == ".text"
+        assert list(idautils.Segments()) == [0x1000]
+    assert database.database.is_empty()
+
+
+def test_call_profiler(tmpdir):
+    import json
+    from pytest_idapro.idapro_internal import record_module
+
+    def get_byte(ea):
+        return ea & 0xff
+
+    records = {}
+    get_byte_record = record_module.record_factory('get_byte', get_byte,
+                                                   records, force=True)
+
+    def get_bytes(ea, size):
+        return [get_byte_record(ea + i) for i in range(size)]
+
+    get_bytes_record = record_module.record_factory('get_bytes', get_bytes,
+                                                    records, force=True)
+
+    class insn_t(object):
+        __module__ = 'ida_ua'
+
+        def __init__(self, ea):
+            self.ea = ea
+
+    insn_record = record_module.record_factory('test_profile_insn_t', insn_t,
+                                               records, force=True)
+
+    record_module.g_profiler = record_module.CallProfiler()
+    try:
+        assert get_bytes_record(0x1000, 4) == [0, 1, 2, 3]
+        assert get_bytes_record(0x1000, 2) == [0, 1]
+        profile_file = str(tmpdir.join("profile.json"))
+        record_module.dump_profile(profile_file)
+
+        # when only profiling, instances are not recorded either
+        record_module.g_recording = False
+        assert insn_record(0x1000).ea == 0x1000
+        assert 'instance_data' not in records['test_profile_insn_t']
+    finally:
+        record_module.g_profiler = None
+        record_module.g_recording = True
+        record_module.g_classes.pop('test_profile_insn_t', None)
+
+    with open(profile_file) as fh:
+        report = json.load(fh)
+    apis = {api['name'].rsplit('.', 1)[-1]: api for api in report['apis']}
+    assert apis['get_byte']['calls'] == 6
+    assert apis['get_byte']['distinct_args'] == 4
+    assert apis['get_bytes']['calls'] == 2
+    assert apis['get_bytes']['self'] <= apis['get_bytes']['cumulative']
+
+    lines = record_module.format_profile(report, 'calls')
+    assert lines[1].endswith('get_byte')
+    with open(profile_file + ".collapsed") as fh:
+        stacks = [line.rsplit(' ', 1)[0] for line in fh]
+    assert any(stack.startswith('test_all.py:test_call_profiler;') and
+               stack.endswith('get_bytes;' + apis['get_byte']['name'])
+               for stack in stacks)
+
+
+def test_record_attributes():
+    from pytest_idapro.idapro_internal import record_module
+
+    class insn_t(object):
+        __module__ = 'ida_ua'
+
+        def __init__(self, ea):
+            self.ea = ea
+            self.ops = [1, 2]
+
+        def size(self):
+            return 4
+
+    classes = dict(record_module.g_classes)
+    decisions = dict(record_module.g_attribute_decisions)
+    records = record_module.RecordDict()
+    try:
+        record_class = record_module.record_factory('insn_t', insn_t,
+                                                    records)
+        insn = record_class(0x1000)
+
+        for _ in range(2):
+            assert insn.ea == 0x1000
+            assert insn.ops == [1, 2]
+            assert insn.size() == 4
+    finally:
+        record_module.g_classes.clear()
+        record_module.g_classes.update(classes)
+        record_module.g_attribute_decisions.clear()
+        record_module.g_attribute_decisions.update(decisions)
+
+    # attributes are recorded once, by the instance only
+    assert sorted(records['insn_t']) == ['call_count', 'instance_data',
+                                         'value_type']
+    instance, = records['insn_t']['instance_data']
+    assert sorted(instance) == ['ea', 'instance_desc', 'ops', 'value_type']
+    assert instance['ea'] == {'value_type': 'value', 'raw_data': 0x1000}
+    assert instance['ops'] == {'value_type': 'value', 'raw_data': [1, 2]}
+
+
+def test_record_filter():
+    import types
+    from pytest_idapro.idapro_internal import record_module
+
+    module = types.ModuleType('ida_fake')
+
+    def get_byte(ea):
+        return 0
+
+    def get_name(ea):
+        return "name"
+
+    for f in (get_byte, get_name):
+        f.__module__ = 'ida_fake'
+        setattr(module, f.__name__, f)
+
+    record_filter = record_module.RecordFilter(include=['ida_*', 'idc.get_*'],
+                                               exclude='ida_fake.get_byte')
+    assert record_filter.module_recorded('ida_fake')
+    assert not record_filter.module_recorded('idautils')
+    assert record_filter.recorded('idc', 'get_name')
+    assert not record_filter.recorded('idc', 'set_name')
+    # idaapi.get_byte is matched against the module defining it as well
+    assert not record_filter.attribute_recorded('idaapi', 'get_byte',
+                                                get_byte)
+    assert not record_module.RecordFilter(
+        exclude=['ida_fake']).module_recorded('ida_fake')
+
+    records = record_module.RecordDict()
+    record_module.g_record_filter = record_filter
+    try:
+        module_record = record_module.record_factory('ida_fake', module,
+                                                     records)
+        assert module_record.get_byte is get_byte
+        assert module_record.get_name(0) == "name"
+        with record_module.filtered(exclude=['*.get_name']):
+            module_record.get_name(1)
+    finally:
+        record_module.g_record_filter = None
+
+    assert 'get_byte' not in records['ida_fake']
+    call_data = records['ida_fake']['get_name']['call_data']
+    assert [c['instance_desc']['args'] for c in call_data] == [(0,)]
+
+
+def test_record_dedup(tmpdir):
+    import json
+    from pytest_idapro.idapro_internal import record_module, replay_module
+
+    def get_name(ea):
+        return "sub_{:x}".format(ea)
+
+    def record_calls(records):
+        get_name_record = record_module.record_factory('get_name', get_name,
+                                                       records, force=True)
+        for ea in (1, 1, 1, 2, 1):
+            get_name_record(ea)
+
+    records = record_module.RecordDict()
+    record_calls(records)
+
+    stream_file = str(tmpdir.join("records.jsonl"))
+    record_module.g_stream = open(stream_file, 'w')
+    try:
+        record_module.g_stream.write(
+            json.dumps(record_module.STREAM_HEADER) + "\n")
+        stream_records = record_module.RecordDict()
+        stream_records.path = []
+        record_calls(stream_records)
+    finally:
+        record_module.g_stream.close()
+        record_module.g_stream = None
+
+    for r in (records, replay_module.load_records(stream_file)):
+        call_data = r['get_name']['call_data']
+        assert [(list(c['instance_desc']['args']),
+                 c['instance_desc'].get('call_indices'))
+                for c in call_data] == [([1], [[0, 3], [4, 1]]),
+                                        ([2], None)]
+
+    call_data = replay_module.load_records(stream_file)['get_name'][
+        'call_data']
+    index = replay_module.InstanceIndex(call_data)
+    callstack = [(cs['caller_file'], cs['caller_line'],
+                  cs['caller_function'])
+                 for cs in call_data[0]['instance_desc']['callstack']]
+    for call_index, ea in enumerate((1, 1, 1, 2, 1)):
+        score, instance = index.select_next('get_name', [ea], {}, callstack,
+                                            call_index)[0]
+        assert score == 0
+        assert instance['instance_desc']['args'] == [ea]
+    assert replay_module.nearest_call_index(call_data[0]['instance_desc'],
+                                            3) == 2
+
+    def get_byte(ea):
+        if ea is None:
+            raise KeyboardInterrupt()
+        return ea
+
+    records = record_module.RecordDict()
+    get_byte_record = record_module.record_factory('get_byte', get_byte,
+                                                   records, force=True)
+    # booleans are not deduplicated into equal integers
+    assert [get_byte_record(v) for v in (1, True)] == [1, True]
+    try:
+        get_byte_record(None)
+    except KeyboardInterrupt:
+        pass
+    call_data = records['get_byte']['call_data']
+    assert [c['instance_desc']['call_index'] for c in call_data] == \
+        [0, 1, 2]
+    assert call_data[2]['instance_desc']['exception']['exception_class'] == \
+        'KeyboardInterrupt'
+
+
+def test_entries_prefilter():
+    import types
+    from pytest_idapro.plugin_base import may_define_entries, scan_entries
+
+    assert may_define_entries(b"class A(ida_kernwin.action_handler_t): pass")
+    assert not may_define_entries(b"# action_handler_t\nimport os\n"
+                                  b"class A(object): pass")
+
+    # handlers inheriting action_handler_t through a class defined elsewhere
+    assert may_define_entries(b"from handlers import Base\n"
+                              b"class A(Base): pass")
+    assert may_define_entries(b"import handlers as h\n"
+                              b"class A(h.Base): pass")
+    assert may_define_entries(b"from handlers import *\n"
+                              b"class A(Base): pass")
+
+    class action_handler_t(object):
+        pass
+
+    class Base(action_handler_t):
+        pass
+
+    class Indirect(Base):
+        pass
+
+    module = types.ModuleType('actions')
+    module.Indirect = Indirect
+    assert scan_entries(module) == (set(), {Indirect})
+
+
+def test_replay_memo():
+    from pytest_idapro.idapro_internal import replay_module
+
+    def call(args, retval, call_indices):
+        return {'instance_desc': {
+            'name': 'get_name', 'args': args, 'kwargs': {}, 'callstack': [],
+            'callback': {}, 'call_index': call_indices[0][0],
+            'call_indices': call_indices,
+            'retval': {'value_type': 'value', 'raw_data': retval}}}
+
+    def get_records():
+        return {'value_type': 'function', 'call_count': 3,
+                'call_data': [call([1], "a", [[0, 2]]),
+                              call([2], "b", [[2, 1]]),
+                              call([3], "c", [[3, 1]])]}
+
+    def replay(replay_mode, memo_size):
+        replay_module.setup([], replay_mode, memo_size=memo_size)
+        records = get_records()
+        get_name = replay_module.replay_factory('get_name',
+                                                {'get_name': records})
+        results = [get_name(ea) for ea in (1, 2, 1, 3, 4, 4, 1)]
+        return (results, records['replay_call_count'],
+                records['replay_index'].cursor, get_name.__memo__)
+
+    records = get_records()
+    assert len(replay_module.CallMemo.build('get_name', records['call_data'],
+                                            2).recorded) == 2
+    try:
+        # memoized calls are counted, and followed in sequential mode, the
+        # same as calls matched by scoring
+        for replay_mode in ('score', 'sequential'):
+            results, call_count, cursor, memo = replay(replay_mode, None)
+            assert memo is not None
+            assert replay_module.memo_key([4], {}) not in memo.recorded
+            assert (results, call_count, cursor) == \
+                replay(replay_mode, 0)[:3]
+        assert results == ["a", "b", "a", "c", "c", "c", "a"]
+        assert call_count == 6
+
+        replay_module.setup([])
+        get_name = replay_module.replay_factory('get_name',
+                                                {'get_name': records})
+        assert [get_name(ea) for ea in (1, 2)] == ["a", "b"]
+        assert records['replay_call_count'] == 1
+
+        # different results for the same arguments are not memoized
+        records['call_data'].append(call([3], "d", [[4, 1]]))
+        get_name = replay_module.replay_factory('get_name',
+                                                {'get_name': records})
+        assert get_name(3) == "c"
+        assert get_name.__memo__ is None
+        assert records['replay_call_count'] == 2
+
+        # function replays and their memo are kept by their module
+        module = replay_module.init_replay(replay_module.ModuleReplay(),
+                                           'ida_name', {'get_name': records})
+        assert module.get_name is module.get_name
+    finally:
+        replay_module.setup([])
+
+
+def test_batch_sender():
+    from multiprocessing import Pipe
+    from pytest_idapro.idapro_internal import transport
+
+    reader, writer = Pipe(duplex=False)
+    sender = transport.BatchSender(writer, max_delay=60)
+    for i in range(transport.BATCH_MAX_MESSAGES):
+        assert not reader.poll()
+        sender.send_batched(i)
+    # full batches are only sent at a boundary
+    assert not reader.poll()
+    sender.boundary()
+    assert reader.recv() == ('batch', list(range(256)))
+
+    sender.send_batched('a')
+    sender.boundary()
+    assert not reader.poll()
+    # messages sent directly are preceded by the pending batch
+    sender.send('b')
+    assert reader.recv() == ('batch', ['a'])
+    assert reader.recv() == 'b'
+
+    # old batches are sent at the next boundary
+    sender = transport.BatchSender(writer, max_delay=0.01)
+    sender.send_batched('c')
+    assert not reader.poll(0.02)
+    sender.boundary()
+    assert reader.recv() == ('batch', ['c'])
+
+
+def test_report_codec(request):
+    from _pytest.runner import CollectReport, TestReport
+    from pytest_idapro import report_codec
+
+    report = TestReport(request.node.nodeid, ("test_all.py", 1, "test"),
+                        {"test": 1}, "failed", "AssertionError: boom",
+                        "call", user_properties=[("key", "value")])
+    encoded = report_codec.encode_report(report)
+    stats = report_codec.CodecStats()
+    decoded = report_codec.decode_report("test", encoded, request.config,
+                                         request.session, stats)
+    assert isinstance(decoded, TestReport)
+    for name in ('nodeid', 'location', 'outcome', 'when',
+                 'user_properties'):
+        assert getattr(decoded, name) == getattr(report, name)
+    assert "AssertionError: boom" in str(decoded.longrepr)
+    assert stats.count == 1
+
+    report = CollectReport("tests/test_all.py", "passed", None,
+                           [request.node])
+    encoded = report_codec.encode_report(report)
+    decoded = report_codec.decode_report("collect", encoded, request.config,
+                                         request.session)
+    assert decoded.nodeid == report.nodeid
+    assert [type(item) for item in decoded.result] == \
+        [report_codec.CollectedItem]
+    assert decoded.result[0].nodeid == request.node.nodeid
+    assert decoded.result[0].name == request.node.name